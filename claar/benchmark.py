@@ -0,0 +1,280 @@
+"""
+Benchmarks for claar.scan
+
+python -m claar.benchmark facts [count]
+    memory and build speed of the file fact representations for synthetic entries
+python -m claar.benchmark scan [files] [results database]
+    full, incremental, pruned and hashing scans of a generated tree, results are stored in SQLite
+"""
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from claar.constants import KB, MB, MILLION, NANOSECONDS_PER_SECOND
+from claar.scan import HEADER_MARKER, Fact, FactBatch, FileScanner
+from claar.sqlite import create_table, datetime_to_sqlite
+
+try:
+    import resource
+except ImportError:  # Windows, the peak RSS is then not measured
+    resource = None
+
+DEFAULT_FACT_COUNT = 10 * MILLION
+SYNTHETIC_PATH = "/data/archive/synthetic/file.bin"
+SYNTHETIC_EPOCH_NS = 1_700_000_000 * NANOSECONDS_PER_SECOND
+
+DEFAULT_SCAN_FILES = 100_000
+DEFAULT_RESULTS_DB = "benchmarks.db"
+SIZE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+SCAN_SCENARIOS = ("full", "incremental", "pruned", "hash")
+
+RESULTS_DEF = """
+    run_at TEXT NOT NULL,
+    version TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    files_per_second REAL NOT NULL,
+    bytes_per_second REAL NOT NULL,
+    peak_rss INTEGER,
+    db_size INTEGER NOT NULL,
+    config TEXT NOT NULL
+"""
+
+
+@dataclass
+class LegacyFact:
+    """
+    The fact representation before FactBatch: a regular dataclass with preformatted strings
+    """
+    mtime: str
+    fsize: str
+    perms: str
+    info: str
+
+
+def synthetic_entry(i: int) -> tuple:
+    """
+    (fsize, mtime_ns, mode, dev, inode) of the i-th synthetic file
+    """
+    return (i * 7919) % MB, SYNTHETIC_EPOCH_NS + i * 1_000_003, stat.S_IFREG | 0o644, 2049, 1_000_000 + i
+
+
+def build_legacy(count: int) -> list:
+    ret = []
+    for i in range(count):
+        fsize, mtime_ns, mode, _, _ = synthetic_entry(i)
+        mtime = datetime_to_sqlite(datetime.fromtimestamp(mtime_ns / NANOSECONDS_PER_SECOND))
+        ret.append((SYNTHETIC_PATH, LegacyFact(mtime, str(fsize), f"{stat.S_IMODE(mode):04o}", "")))
+    return ret
+
+
+def build_tuples(count: int) -> list:
+    return [(SYNTHETIC_PATH, Fact(*synthetic_entry(i))) for i in range(count)]
+
+
+def build_batch(count: int) -> FactBatch:
+    batch = FactBatch()
+    for i in range(count):
+        batch.append(SYNTHETIC_PATH, Fact(*synthetic_entry(i)))
+    return batch
+
+
+FACT_BUILDERS: Dict[str, Callable[[int], object]] = {"dataclass + strings": build_legacy,
+                                                     "Fact (named tuple)": build_tuples,
+                                                     "FactBatch (arrays)": build_batch}
+
+
+def bench_facts(count: int = DEFAULT_FACT_COUNT) -> Dict[str, tuple]:
+    """
+    Build 'count' synthetic facts in every representation and measure memory and speed.
+    All entries share one path string, so the numbers show the cost of the facts themselves.
+    :return: name -> (bytes per entry, entries per second)
+    """
+    results = {}
+    for name, builder in FACT_BUILDERS.items():
+        # timed without tracemalloc, it slows down allocation considerably
+        start = time.perf_counter()
+        facts = builder(count)
+        elapsed = time.perf_counter() - start
+        del facts
+        tracemalloc.start()
+        facts = builder(count)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del facts
+        results[name] = (memory / count, count / elapsed)
+        print(f"{name:22} {memory / MB:10.1f} MB {memory / count:8.1f} bytes/entry {count / elapsed:12.0f} entries/s")
+    return results
+
+
+@dataclass
+class TreeConfig:
+    """
+    Shape of a synthetic tree, the same config and seed always give the same tree
+    :ivar depth: number of directory levels below the root
+    :ivar fanout: number of subdirectories per directory
+    :ivar files: total number of files, spread over all directories
+    :ivar mean_size: mean file size in bytes
+    :ivar distribution: fixed, uniform (0 .. 2 * mean) or lognormal (long tail, like real data)
+    :ivar text_share: part of the files that are text files with a FILE_INFORMATION header
+    :ivar change_share: part of the files modified before the incremental scans
+    """
+    depth: int = 3
+    fanout: int = 8
+    files: int = DEFAULT_SCAN_FILES
+    mean_size: int = 4 * KB
+    distribution: str = "lognormal"
+    text_share: float = 0.3
+    change_share: float = 0.01
+    seed: int = 42
+
+    def file_size(self, rng: random.Random) -> int:
+        if self.distribution == "fixed":
+            return self.mean_size
+        if self.distribution == "uniform":
+            return rng.randint(0, 2 * self.mean_size)
+        if self.distribution == "lognormal":
+            # sigma 1.5, mu chosen so the mean of the distribution equals mean_size
+            return int(rng.lognormvariate(math.log(max(self.mean_size, 1)) - 1.125, 1.5))
+        raise ValueError(f"Unknown size distribution {self.distribution}, use one of {SIZE_DISTRIBUTIONS}")
+
+
+def generate_tree(root: str, config: TreeConfig) -> Tuple[List[str], int]:
+    """
+    Create a reproducible synthetic tree below root
+    :return: (paths of the files, total number of bytes)
+    """
+    rng = random.Random(config.seed)
+    dirs = [root]
+    level = [root]
+    for depth in range(config.depth):
+        level = [os.path.join(parent, f"d{depth}_{i}") for parent in level for i in range(config.fanout)]
+        dirs += level
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+    paths = []
+    total = 0
+    for i in range(config.files):
+        size = config.file_size(rng)
+        directory = dirs[rng.randrange(len(dirs))]
+        if rng.random() < config.text_share:
+            path = os.path.join(directory, f"f{i}.txt")
+            line = HEADER_MARKER + f"synthetic;file {i};{config.seed}\n".encode()
+            content = (line + b"x" * 79 + b"\n") * (size // (len(line) + 80) + 1)
+            content = content[:max(size, len(line))]
+        else:
+            path = os.path.join(directory, f"f{i}.bin")
+            content = rng.randbytes(size)
+        with open(path, "wb") as f:
+            f.write(content)
+        paths.append(path)
+        total += len(content)
+    return paths, total
+
+
+def modify_files(paths: List[str], config: TreeConfig) -> int:
+    """
+    Append to a reproducible selection of the files, as changes for the incremental scans
+    :return: number of files modified
+    """
+    rng = random.Random(config.seed + 1)
+    changed = rng.sample(paths, int(len(paths) * config.change_share))
+    for path in changed:
+        with open(path, "ab") as f:
+            f.write(b"changed\n")
+    return len(changed)
+
+
+def run_scenario(scenario: str, root: str, db_path: str) -> Tuple[float, Optional[int]]:
+    """
+    Run one scan scenario, in a fresh worker process so the peak RSS is its own
+    :return: (seconds, peak RSS in bytes or None where the platform does not report it)
+    """
+    options = {"full": {}, "incremental": {}, "pruned": {"prune": True}, "hash": {"hash_algorithm": "sha256"}}
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        FileScanner(root, db_path, **options[scenario]).scan()
+    elapsed = time.perf_counter() - start
+    if resource is None:
+        return elapsed, None
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * KB  # ru_maxrss is in KB on Linux
+
+
+def code_version() -> str:
+    """
+    Git revision of the code under test, so results can be compared across versions
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_scan(config: TreeConfig, results_db: str = DEFAULT_RESULTS_DB, keep: bool = False) -> List[tuple]:
+    """
+    Generate a tree and measure a full scan, an incremental scan after modifying change_share
+    of the files, a pruned scan of the unchanged tree and a full scan with hashing.
+    Every result is appended to the table scan_benchmarks of results_db.
+    :param keep: keep the generated tree and databases (their location is printed)
+    :return: the stored result rows
+    """
+    work_dir = tempfile.mkdtemp(prefix="claar-bench-")
+    root = os.path.join(work_dir, "tree")
+    rows = []
+    try:
+        start = time.perf_counter()
+        paths, total = generate_tree(root, config)
+        print(f"Generated {len(paths)} files, {total / MB:.1f} MB in {time.perf_counter() - start:.1f}s: {work_dir}")
+        run_at = datetime_to_sqlite(datetime.now())
+        version = code_version()
+        db_path = os.path.join(work_dir, "scan.db")
+        for scenario in SCAN_SCENARIOS:
+            if scenario == "incremental":
+                modify_files(paths, config)
+            scenario_db = os.path.join(work_dir, "hash.db") if scenario == "hash" else db_path
+            with ProcessPoolExecutor(1) as pool:
+                seconds, peak_rss = pool.submit(run_scenario, scenario, root, scenario_db).result()
+            rows.append((run_at, version, scenario, len(paths), total, seconds, len(paths) / seconds,
+                         total / seconds, peak_rss, os.path.getsize(scenario_db), json.dumps(asdict(config))))
+            rss = f"{peak_rss / MB:8.1f}" if peak_rss is not None else f"{'n/a':>8}"
+            print(f"{scenario:12} {seconds:8.2f}s {len(paths) / seconds:12.0f} files/s "
+                  f"{total / seconds / MB:10.1f} MB/s {rss} MB RSS "
+                  f"{os.path.getsize(scenario_db) / MB:8.1f} MB db")
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    conn = sqlite3.connect(results_db)
+    ok, err = create_table(conn, "scan_benchmarks", RESULTS_DEF, drop=False, create_if_exists=True)
+    if not ok:
+        raise RuntimeError(f"Kon de tabel scan_benchmarks niet aanmaken of openen: {err}")
+    conn.executemany(f"INSERT INTO scan_benchmarks VALUES ({', '.join('?' * 11)})", rows)
+    conn.commit()
+    conn.close()
+    return rows
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("facts", "scan"):
+        raise SystemExit(__doc__)
+    if sys.argv[1] == "facts":
+        bench_facts(int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_FACT_COUNT)
+    else:
+        bench_scan(TreeConfig(files=int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SCAN_FILES),
+                   sys.argv[3] if len(sys.argv) > 3 else DEFAULT_RESULTS_DB)
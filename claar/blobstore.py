@@ -0,0 +1,326 @@
+"""
+Deduplicating blob store with content-defined chunking
+
+Files are cut into chunks at positions chosen by the content itself: a cut is made where
+a rolling hash over the last CDC_WINDOW bytes has its low bits zero. An insertion or
+deletion therefore only changes the chunks around it, the boundaries after it fall back
+in place. Every unique chunk is appended once to a pack file; the chunk index and the
+manifest of every stored file (its list of chunks) live in SQLite. Deleting or replacing a
+file only drops references, compact() rewrites the packs to reclaim unreferenced chunks.
+
+The rolling hash is the sum of a random value per byte over the window, computed with
+NumPy cumulative sums, so chunking runs at memory speed instead of one Python step per byte.
+
+Layout of a store directory:
+    index.db            chunks, files and manifests tables
+    packs/NNNNNN.pack   concatenated chunks
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from claar.constants import KB, MB
+from claar.sqlite import create_table, datetime_to_sqlite
+
+CDC_WINDOW = 64
+CDC_MIN = 16 * KB
+CDC_AVERAGE = 64 * KB  # a power of 2
+CDC_MAX = 256 * KB
+CDC_READ = 8 * MB
+CDC_SEED = 20240501  # changing it changes all chunk boundaries
+PACK_SIZE = 256 * MB
+CHUNK_ALGORITHM = "sha256"
+
+GEAR = np.random.default_rng(CDC_SEED).integers(0, 2 ** 64, size=256, dtype=np.uint64)
+
+CHUNKS_DEF = """
+    digest TEXT PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+"""
+
+FILES_DEF = """
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER,
+    digest TEXT NOT NULL,
+    chunks INTEGER NOT NULL,
+    stored TEXT NOT NULL
+"""
+
+MANIFESTS_DEF = """
+    name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (name, seq)
+"""
+
+
+def chunk_boundaries(data: bytes,
+                     final: bool = True,
+                     min_size: int = CDC_MIN,
+                     average: int = CDC_AVERAGE,
+                     max_size: int = CDC_MAX) -> List[int]:
+    """
+    Content-defined cut points in a buffer that starts at a chunk boundary
+    :param data: bytes to chunk
+    :param final: True if the data ends the file, else the tail after the last cut is left over
+    :return: end offsets of the chunks
+    """
+    size = len(data)
+    if size == 0:
+        return []
+    values = GEAR[np.frombuffer(data, dtype=np.uint8)]
+    sums = np.cumsum(values, dtype=np.uint64)  # wraps around, like the window sums below
+    window = sums.copy()
+    window[CDC_WINDOW:] -= sums[:-CDC_WINDOW]
+    # the window never reaches before the buffer start, min_size >= CDC_WINDOW
+    candidates = np.flatnonzero((window & np.uint64(average - 1)) == 0) + 1
+    cuts = []
+    start = 0
+    while True:
+        i = np.searchsorted(candidates, start + min_size)
+        cut = int(candidates[i]) if i < len(candidates) else size + 1
+        cut = min(cut, start + max_size)
+        if cut > size:
+            if final:
+                cuts.append(size)
+            return cuts
+        cuts.append(cut)
+        start = cut
+        if start == size:
+            return cuts
+
+
+def iter_chunks(file_path: str) -> Iterator[bytes]:
+    """
+    Read a file and yield its content-defined chunks
+    """
+    rest = b""
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(CDC_READ)
+            data = rest + block
+            final = not block
+            start = 0
+            for cut in chunk_boundaries(data, final):
+                yield data[start:cut]
+                start = cut
+            rest = data[start:]
+            if final:
+                return
+
+
+class BlobStore:
+    """
+    Store files as deduplicated chunks in a directory.
+
+    :ivar written: bytes written to the packs by this instance
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.pack_dir = os.path.join(directory, "packs")
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"))
+        for name, definition in [("chunks", CHUNKS_DEF), ("files", FILES_DEF)]:
+            ok, err = create_table(self.conn, name, definition, drop=False, create_if_exists=True)
+            if not ok:
+                raise RuntimeError(f"Kon de tabel {name} niet aanmaken of openen: {err}")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS manifests ({MANIFESTS_DEF}) WITHOUT ROWID")
+        self.conn.commit()
+        self.written = 0
+        self._readers: Dict[int, int] = {}
+        self._pack, self._pack_file = None, None
+
+    def __enter__(self) -> "BlobStore":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._pack_file is not None:
+            self._pack_file.close()
+        for fd in self._readers.values():
+            os.close(fd)
+        self._readers = {}
+        self.conn.close()
+
+    def _pack_path(self, pack: int) -> str:
+        return os.path.join(self.pack_dir, f"{pack:06d}.pack")
+
+    def _append(self, chunk: bytes) -> Tuple[int, int]:
+        """
+        Append a chunk to the current pack, a new pack is started when it is full
+        :return: (pack number, offset)
+        """
+        if self._pack_file is None or self._pack_file.tell() + len(chunk) > PACK_SIZE:
+            if self._pack_file is None:
+                self._pack = self.conn.execute("SELECT COALESCE(MAX(pack), 0) FROM chunks").fetchone()[0]
+                if self._pack == 0 or os.path.getsize(self._pack_path(self._pack)) + len(chunk) > PACK_SIZE:
+                    self._pack += 1
+            else:
+                self._pack_file.close()
+                self._pack += 1
+            self._pack_file = open(self._pack_path(self._pack), "ab")
+        offset = self._pack_file.tell()
+        self._pack_file.write(chunk)
+        self.written += len(chunk)
+        return self._pack, offset
+
+    def put(self, file_path: str, name: Optional[str] = None) -> Tuple[int, int]:
+        """
+        Store a file; only chunks that are not in the store yet are written.
+        Storing under an existing name replaces that file.
+        :param name: name in the store, default the file path
+        :return: (size of the file, number of new bytes written to the packs)
+        """
+        name = name or file_path
+        st = os.stat(file_path)
+        hasher = hashlib.new(CHUNK_ALGORITHM)
+        manifest = []
+        size = new = 0
+        for chunk in iter_chunks(file_path):
+            hasher.update(chunk)
+            digest = hashlib.new(CHUNK_ALGORITHM, chunk).hexdigest()
+            manifest.append(digest)
+            size += len(chunk)
+            if self.conn.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone() is None:
+                pack, offset = self._append(chunk)
+                self.conn.execute("INSERT INTO chunks (digest, pack, offset, size, refs) VALUES (?, ?, ?, ?, 0)",
+                                  (digest, pack, offset, len(chunk)))
+                new += len(chunk)
+        if self._pack_file is not None:
+            # the chunks have to be on disk before the index refers to them
+            self._pack_file.flush()
+            os.fsync(self._pack_file.fileno())
+        self._unref(name)
+        self.conn.executemany("INSERT INTO manifests (name, seq, digest) VALUES (?, ?, ?)",
+                              [(name, seq, digest) for seq, digest in enumerate(manifest)])
+        self.conn.executemany("UPDATE chunks SET refs = refs + 1 WHERE digest = ?", [(d,) for d in manifest])
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                          (name, size, st.st_mtime_ns, hasher.hexdigest(), len(manifest),
+                           datetime_to_sqlite(datetime.now())))
+        self.conn.commit()
+        return size, new
+
+    def _unref(self, name: str) -> None:
+        self.conn.execute("""
+            UPDATE chunks
+               SET refs = refs - (SELECT COUNT(*) FROM manifests m WHERE m.name = ? AND m.digest = chunks.digest)
+             WHERE digest IN (SELECT digest FROM manifests WHERE name = ?)""", (name, name))
+        self.conn.execute("DELETE FROM manifests WHERE name = ?", (name,))
+        self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def delete(self, name: str) -> None:
+        """
+        Remove a file from the store. Its chunks stay in the packs, with one reference less,
+        until compact() is run.
+        """
+        self._unref(name)
+        self.conn.commit()
+
+    def compact(self) -> int:
+        """
+        Reclaim the space of chunks that are no longer referenced: the live chunks of every
+        pack holding such chunks are copied to new packs, then the old packs are removed.
+        The index is committed before any pack is removed, so an interruption loses nothing.
+        :return: number of bytes freed
+        """
+        packs = [pack for pack, in self.conn.execute(
+            "SELECT DISTINCT pack FROM chunks WHERE refs <= 0 ORDER BY pack")]
+        if not packs:
+            return 0
+        for fd in self._readers.values():
+            os.close(fd)
+        self._readers = {}
+        if self._pack_file is not None:
+            self._pack_file.close()
+        # never append to a pack that is being rewritten
+        self._pack = self.conn.execute("SELECT MAX(pack) FROM chunks").fetchone()[0] + 1
+        self._pack_file = open(self._pack_path(self._pack), "ab")
+        moved = []
+        freed = 0
+        for pack in packs:
+            freed += os.path.getsize(self._pack_path(pack))
+            with open(self._pack_path(pack), "rb", buffering=0) as f:
+                for digest, offset, size in self.conn.execute(
+                        "SELECT digest, offset, size FROM chunks WHERE pack = ? AND refs > 0 ORDER BY offset", (pack,)):
+                    moved.append(self._append(os.pread(f.fileno(), size, offset)) + (digest,))
+                    freed -= size
+        self._pack_file.flush()
+        os.fsync(self._pack_file.fileno())
+        self.conn.executemany("UPDATE chunks SET pack = ?, offset = ? WHERE digest = ?", moved)
+        self.conn.executemany("DELETE FROM chunks WHERE pack = ? AND refs <= 0", [(pack,) for pack in packs])
+        self.conn.commit()
+        for pack in packs:
+            os.remove(self._pack_path(pack))
+        return freed
+
+    def chunks(self, name: str) -> Iterator[bytes]:
+        """
+        Stream the chunks of a stored file
+        """
+        if self.conn.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is None:
+            raise KeyError(f"{name} is not in the store")
+        rows = self.conn.execute("""
+            SELECT c.pack, c.offset, c.size
+              FROM manifests m JOIN chunks c ON c.digest = m.digest
+             WHERE m.name = ?
+             ORDER BY m.seq""", (name,)).fetchall()
+        if self._pack_file is not None:
+            self._pack_file.flush()
+        for pack, offset, size in rows:
+            if pack not in self._readers:
+                self._readers[pack] = os.open(self._pack_path(pack), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            yield os.pread(self._readers[pack], size, offset)
+
+    def get(self, name: str, target: str, verify: bool = True) -> int:
+        """
+        Restore a stored file, atomically through a temporary file next to the target
+        :param verify: compare the digest of the restored contents with the stored one
+        :return: number of bytes restored
+        """
+        size, digest = self.conn.execute("SELECT size, digest FROM files WHERE name = ?", (name,)).fetchone() \
+            or (None, None)
+        if digest is None:
+            raise KeyError(f"{name} is not in the store")
+        hasher = hashlib.new(CHUNK_ALGORITHM)
+        directory, base = os.path.split(os.path.abspath(target))
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{base}.", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.chunks(name):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if verify and hasher.hexdigest() != digest:
+                raise ValueError(f"Restored contents of {name} do not match the stored digest")
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Sizes of the store: logical (sum of the stored files), unique (referenced chunks)
+        and packed (everything in the packs, including chunks of deleted files until compact())
+        """
+        logical, files = self.conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM files").fetchone()
+        unique, chunks = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM chunks WHERE refs > 0").fetchone()
+        packed = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+        return {"files": files, "chunks": chunks, "logical": logical, "unique": unique, "packed": packed}
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
@@ -31,12 +31,13 @@ SECONDS_PER_DAY = HOURS_PER_DAY * SECONDS_PER_HOUR
 
 MILLISECONDS_PER_SECOND = 1_000
 MILLISECONDS_PER_MINUTE = MILLISECONDS_PER_SECOND * SECONDS_PER_MINUTE
-MILLISECONDS_PER_QUARTER_HOUR = MILLISECONDS_PER_MINUTE * SECONDS_PER_HOUR // 4
+MILLISECONDS_PER_QUARTER_HOUR = MILLISECONDS_PER_MINUTE * MINUTES_PER_HOUR // 4
 MILLISECONDS_PER_HOUR = MILLISECONDS_PER_MINUTE * MINUTES_PER_HOUR
 MILLISECONDS_PER_DAY = MILLISECONDS_PER_HOUR * HOURS_PER_DAY
+QUARTERS_PER_DAY = MILLISECONDS_PER_DAY // MILLISECONDS_PER_QUARTER_HOUR
 
-NANOSECONDS_PER_MILLISECOND = 1_000
-NANOSECONDS_PER_SECOND = 1_000_000
+NANOSECONDS_PER_MILLISECOND = 1_000_000
+NANOSECONDS_PER_SECOND = 1_000_000_000
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+"""
+rsync-style mirroring of one local directory tree into another
+
+Files whose size and mtime match are skipped. For a changed file, the destination is cut
+into blocks with a weak (rolling, rsync/Adler style) and a strong checksum. The weak
+checksum of every offset of the source is computed a window at a time with NumPy cumulative
+sums in wrapping 32-bit arithmetic; only offsets whose weak checksum is known get a strong
+check. The new file is rebuilt in a temporary file from the matching blocks of the old
+destination (copied in the kernel with copy_range where the platform allows it) and the
+changed bytes of the source, and then replaces the destination atomically.
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from claar.constants import KB, MB
+from claar.filesystem import copy_file, copy_range, iter_files, new_hasher
+from claar.logger_tools import SCRIPT_LOGGER
+
+SYNC_WORKERS = 4
+BLOCK_MIN = 2 * KB
+BLOCK_MAX = 128 * KB
+SCAN_WINDOW = 2 * MB  # bytes whose weak checksums are computed in one go, about 20 bytes of memory per byte
+STRONG_ALGORITHM = "blake2b"
+STRONG_SIZE = 16
+
+# an operation of a delta: (offset in the old destination or None for literal source data,
+# offset in the source, length)
+Operation = Tuple[Optional[int], int, int]
+
+
+class SyncResult(NamedTuple):
+    path: str  # relative to the roots
+    action: str  # copy, delta, skip or delete
+    size: int  # size of the source file
+    transferred: int  # bytes read from the source to write the new file
+    reused: int  # bytes taken over from the old destination
+
+
+def block_size(fsize: int) -> int:
+    """
+    Block size for a file: about the square root of its size, like rsync, rounded to a KB
+    """
+    return min(BLOCK_MAX, max(BLOCK_MIN, int(fsize ** 0.5) // KB * KB))
+
+
+def _pack(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (b << np.uint32(16)) | (a & np.uint32(0xFFFF))
+
+
+def weak_checksums(data: bytes, block: int) -> np.ndarray:
+    """
+    Weak rolling checksum of every block-sized window of data, window k starting at offset k:
+    a = sum of the bytes, b = sum of (block - i) * byte i, packed as (b mod 2^16) << 16 | (a mod 2^16).
+    Only the low 16 bits are kept, so all sums may wrap around in uint32.
+    """
+    n = len(data)
+    x = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    s = np.zeros(n + 1, dtype=np.uint32)
+    np.cumsum(x, dtype=np.uint32, out=s[1:])
+    x *= np.arange(n, dtype=np.uint32)
+    t = np.zeros(n + 1, dtype=np.uint32)
+    np.cumsum(x, dtype=np.uint32, out=t[1:])
+    del x
+    a = s[block:] - s[:-block]
+    del s
+    # sum of (k + block - i) * x_i over the window = (k + block) * a - sum of i * x_i
+    b = np.arange(block, n + 1, dtype=np.uint32) * a
+    b -= t[block:]
+    b += t[:-block]
+    return _pack(a, b)
+
+
+def _strong(data) -> bytes:
+    hasher = new_hasher(STRONG_ALGORITHM, STRONG_SIZE)
+    hasher.update(data)
+    return hasher.digest()
+
+
+def signature(f: BinaryIO, fsize: int, block: int) -> Dict[int, List[Tuple[bytes, int]]]:
+    """
+    Checksums of the full blocks of the destination
+    :param f: the destination, opened in binary mode
+    :return: weak checksum -> [(strong checksum, block offset)]
+    """
+    blocks: Dict[int, List[Tuple[bytes, int]]] = {}
+    weights = np.arange(block, 0, -1, dtype=np.uint32)
+    window = max(1, SCAN_WINDOW // block) * block
+    for start in range(0, fsize - fsize % block, window):
+        f.seek(start)
+        data = f.read(min(window, fsize - fsize % block - start))
+        # only the block starts are needed here, so sum the blocks directly instead of rolling
+        x = np.frombuffer(data, dtype=np.uint8).reshape(-1, block)
+        weak = _pack(x.sum(axis=1, dtype=np.uint32), x.dot(weights).astype(np.uint32))
+        for i, value in enumerate(weak.tolist()):
+            offset = i * block
+            blocks.setdefault(value, []).append((_strong(data[offset:offset + block]), start + offset))
+    return blocks
+
+
+def delta(src: BinaryIO, src_size: int, blocks: Dict[int, List[Tuple[bytes, int]]], block: int) -> List[Operation]:
+    """
+    Express the source as blocks of the old destination and literal ranges of the source
+    :param src: the source, opened in binary mode
+    :return: operations (old offset or None, source offset, length), in source order
+    """
+    ops: List[Operation] = []
+    known = np.fromiter(blocks.keys(), dtype=np.uint32, count=len(blocks))
+    position = literal = 0  # position: next source byte to cover, literal: start of the pending literal range
+    window_start = 0
+    while window_start < src_size and known.size:
+        src.seek(window_start)
+        data = src.read(min(SCAN_WINDOW + block - 1, src_size - window_start))
+        if len(data) < block:
+            break
+        weak = weak_checksums(data, block)
+        for k in np.flatnonzero(np.isin(weak, known)).tolist():
+            offset = window_start + k
+            if offset < position:
+                continue
+            strong = _strong(data[k:k + block])
+            for candidate, old_offset in blocks[int(weak[k])]:
+                if candidate == strong:
+                    if offset > literal:
+                        ops.append((None, literal, offset - literal))
+                    ops.append((old_offset, offset, block))
+                    position = literal = offset + block
+                    break
+        window_start += SCAN_WINDOW
+    if src_size > literal:
+        ops.append((None, literal, src_size - literal))
+    return ops
+
+
+def rebuild(source: str, target: str, ops: List[Operation]) -> None:
+    """
+    Write the new version of target from the operations, atomically
+    """
+    directory, name = os.path.split(os.path.abspath(target))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+    try:
+        with open(source, "rb", buffering=0) as src, open(target, "rb", buffering=0) as old:
+            for old_offset, offset, length in ops:
+                if old_offset is None:
+                    copy_range(src.fileno(), fd, offset, length)
+                else:
+                    copy_range(old.fileno(), fd, old_offset, length)
+        os.close(fd)
+        fd = -1
+        os.utime(tmp_path, ns=(os.stat(source).st_atime_ns, os.stat(source).st_mtime_ns))
+        os.chmod(tmp_path, os.stat(source).st_mode & 0o7777)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if fd >= 0:
+            os.close(fd)
+        os.remove(tmp_path)
+        raise
+
+
+def sync_file(source: str, target: str, relative: str, dry_run: bool = False) -> SyncResult:
+    """
+    Bring one target file in line with its source
+    """
+    st = os.stat(source)
+    try:
+        tt = os.stat(target)
+    except FileNotFoundError:
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            copy_file(source, target)
+        return SyncResult(relative, "copy", st.st_size, st.st_size, 0)
+    if tt.st_size == st.st_size and tt.st_mtime_ns == st.st_mtime_ns:
+        return SyncResult(relative, "skip", st.st_size, 0, 0)
+    block = block_size(tt.st_size)
+    with open(target, "rb") as old, open(source, "rb") as src:
+        ops = delta(src, st.st_size, signature(old, tt.st_size, block), block)
+    reused = sum(length for old_offset, _, length in ops if old_offset is not None)
+    if not dry_run:
+        rebuild(source, target, ops)
+    return SyncResult(relative, "delta", st.st_size, st.st_size - reused, reused)
+
+
+def iter_sync(source_root: str,
+              target_root: str,
+              workers: int = SYNC_WORKERS,
+              dry_run: bool = False,
+              delete: bool = False) -> Iterator[SyncResult]:
+    """
+    Mirror source_root into target_root, several files at a time
+    :param dry_run: only compute what would be transferred, change nothing
+    :param delete: remove target files that are not in the source; nothing is removed below
+                   source directories that could not be listed
+    :return: a SyncResult per file, in source order, followed by the deletions
+    """
+    unreadable = []
+
+    def skip(error: OSError) -> None:
+        SCRIPT_LOGGER.warning(f"Cannot list {error.filename}, it is not synchronised: {error}")
+        unreadable.append(os.path.relpath(error.filename, source_root) + os.sep)
+
+    relatives = [os.path.relpath(entry.path, source_root)
+                 for entry in iter_files(source_root, recursive=True, onerror=skip)]
+    with ThreadPoolExecutor(workers) as pool:
+        yield from pool.map(lambda relative: sync_file(os.path.join(source_root, relative),
+                                                       os.path.join(target_root, relative), relative, dry_run),
+                            relatives)
+    if delete and os.path.isdir(target_root):
+        wanted = set(relatives)
+        for entry in iter_files(target_root, recursive=True):
+            relative = os.path.relpath(entry.path, target_root)
+            if relative not in wanted and not relative.startswith(tuple(unreadable)):
+                if not dry_run:
+                    os.remove(entry.path)
+                yield SyncResult(relative, "delete", 0, 0, 0)
+
+
+def sync_directories(source_root: str,
+                     target_root: str,
+                     workers: int = SYNC_WORKERS,
+                     dry_run: bool = False,
+                     delete: bool = False) -> Dict[str, int]:
+    """
+    Mirror source_root into target_root and report the totals, see iter_sync
+    :return: number of files per action and the bytes transferred and reused
+    """
+    totals = {"copy": 0, "delta": 0, "skip": 0, "delete": 0, "size": 0, "transferred": 0, "reused": 0}
+    for result in iter_sync(source_root, target_root, workers, dry_run, delete):
+        totals[result.action] += 1
+        totals["size"] += result.size
+        totals["transferred"] += result.transferred
+        totals["reused"] += result.reused
+    SCRIPT_LOGGER.info(f"{'Would transfer' if dry_run else 'Transferred'} {totals['transferred'] / MB:.1f} MB of "
+                       f"{totals['size'] / MB:.1f} MB ({totals['reused'] / MB:.1f} MB reused): "
+                       f"{totals['copy']} copied, {totals['delta']} updated, {totals['skip']} unchanged, "
+                       f"{totals['delete']} deleted.")
+    return totals
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
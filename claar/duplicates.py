@@ -0,0 +1,204 @@
+"""
+Find duplicate files in the inventory of claar.scan.FileScanner
+
+Files are first grouped by size in SQL. Only same-size candidates get a partial hash of
+their first and last block, and only files that still collide after that are hashed
+completely. Digests already present in the hash cache of the scanner are reused.
+"""
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from claar.constants import KB
+from claar.filesystem import file_hash
+from claar.scan import HASH_CHUNK
+from claar.sqlite import create_table
+
+PARTIAL_BLOCK = 64 * KB
+DUPLICATE_WORKERS = 8
+DUPLICATE_ALGORITHM = "sha256"
+BUCKET_BATCH = 10_000  # number of candidate files handled per round
+
+DUPLICATES_DEF = """
+    group_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    fsize INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (group_id, path)
+"""
+
+Candidate = Tuple[str, int, int, int, int]  # path, fsize, dev, inode, mtime_ns
+
+
+def partial_hash(path: str,
+                 fsize: int,
+                 block: int = PARTIAL_BLOCK,
+                 algorithm: str = DUPLICATE_ALGORITHM) -> Optional[str]:
+    """
+    Hash the first and the last block of a file with two reads.
+    For files up to two blocks this is the hash of the whole file.
+    :return: hex digest or None if the file can not be read
+    """
+    hasher = hashlib.new(algorithm)
+    try:
+        with open(path, "rb") as f:
+            if fsize <= 2 * block:
+                hasher.update(f.read(fsize))
+            else:
+                hasher.update(f.read(block))
+                f.seek(fsize - block)
+                hasher.update(f.read(block))
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+def full_hash(path: str, algorithm: str = DUPLICATE_ALGORITHM) -> Optional[str]:
+    """
+    Hash the whole file, None if it can not be read
+    """
+    try:
+        return file_hash(path, algorithm, HASH_CHUNK)
+    except OSError:
+        return None
+
+
+def size_buckets(conn: sqlite3.Connection, table: str, min_size: int) -> Iterator[List[Candidate]]:
+    """
+    Yield lists of files with the same size, only for sizes that occur more than once.
+    Hard links (same dev and inode) count as one file, they do not take extra space.
+    """
+    cur = conn.execute(f"""
+        SELECT path, fsize, dev, inode, mtime_ns
+          FROM {table}
+         WHERE fsize >= :min
+           AND fsize IN (SELECT fsize FROM {table}
+                          WHERE fsize >= :min
+                          GROUP BY fsize
+                         HAVING COUNT(DISTINCT COALESCE(dev, 0) || ':' || COALESCE(inode, path)) > 1)
+         GROUP BY fsize, COALESCE(dev, 0), COALESCE(inode, path)
+         ORDER BY fsize
+        """, {"min": min_size})
+    for _, bucket in groupby(cur, key=lambda row: row[1]):
+        bucket = list(bucket)
+        if len(bucket) > 1:
+            yield bucket
+
+
+def collisions(candidates: List[Candidate], digests: List[Optional[str]]) -> List[List[Candidate]]:
+    """
+    Group candidates on (size, digest) and keep the groups with more than one member
+    """
+    groups: Dict[Tuple[int, str], List[Candidate]] = {}
+    for candidate, digest in zip(candidates, digests):
+        if digest is not None:
+            groups.setdefault((candidate[1], digest), []).append(candidate)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+class DuplicateFinder:
+    """
+    Detect duplicate files in a scanner inventory and store them in {table}_duplicates
+
+    :ivar bytes_read: number of bytes read from disk to decide
+    :ivar reclaimable: number of bytes that would be freed by keeping one copy per group
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 table: str = "files",
+                 workers: int = DUPLICATE_WORKERS,
+                 min_size: int = 1,
+                 algorithm: str = DUPLICATE_ALGORITHM) -> None:
+        self.conn = sqlite3.connect(db_path)
+        self.table = table
+        self.table_duplicates = f"{table}_duplicates"
+        self.table_hashes = f"{table}_hashes"
+        self.workers = workers
+        self.min_size = min_size
+        self.algorithm = algorithm
+        self.bytes_read = 0
+        self.reclaimable = 0
+        self.groups = 0
+        ok, err = create_table(self.conn, self.table_duplicates, DUPLICATES_DEF, drop=True)
+        if not ok:
+            raise RuntimeError(f"Kon de tabel {self.table_duplicates} niet aanmaken: {err}")
+
+    def cached_digest(self, candidate: Candidate) -> Optional[str]:
+        """
+        Full digest from the hash cache of the scanner, if it is still valid for this file
+        """
+        try:
+            row = self.conn.execute(
+                f"""SELECT digest FROM {self.table_hashes}
+                     WHERE dev = ? AND inode = ? AND algorithm = ? AND fsize = ? AND mtime_ns = ?""",
+                (candidate[2], candidate[3], self.algorithm, candidate[1], candidate[4])).fetchone()
+        except sqlite3.Error:  # no hash cache in this database
+            return None
+        return row[0] if row else None
+
+    def run(self) -> int:
+        """
+        Find all duplicate groups
+        :return: total number of reclaimable bytes
+        """
+        with ThreadPoolExecutor(self.workers) as pool:
+            batch = []
+            for bucket in size_buckets(self.conn, self.table, self.min_size):
+                batch += bucket
+                if len(batch) >= BUCKET_BATCH:
+                    self.process(pool, batch)
+                    batch = []
+            self.process(pool, batch)
+        self.conn.commit()
+        print(f"{self.groups} duplicate groups, {self.reclaimable} bytes reclaimable, "
+              f"{self.bytes_read} bytes read.")
+        return self.reclaimable
+
+    def process(self, pool: ThreadPoolExecutor, candidates: List[Candidate]) -> None:
+        """
+        Resolve a batch of same-size candidates: partial hashes first, full hashes for what still collides
+        """
+        if not candidates:
+            return
+        partials = dict(zip(candidates, pool.map(
+            lambda c: partial_hash(c[0], c[1], algorithm=self.algorithm), candidates)))
+        self.bytes_read += sum(min(c[1], 2 * PARTIAL_BLOCK) for c in candidates)
+        for group in collisions(candidates, [partials[c] for c in candidates]):
+            if group[0][1] <= 2 * PARTIAL_BLOCK:
+                # the partial hash covered the whole file
+                self.store(group, [partials[c] for c in group])
+                continue
+            digests = {c: self.cached_digest(c) for c in group}
+            missing = [c for c in group if digests[c] is None]
+            digests.update(zip(missing, pool.map(lambda c: full_hash(c[0], self.algorithm), missing)))
+            self.bytes_read += sum(c[1] for c in missing)
+            for final in collisions(group, [digests[c] for c in group]):
+                self.store(final, [digests[c] for c in final])
+
+    def store(self, group: List[Candidate], digests: List[str]) -> None:
+        """
+        Write one duplicate group
+        """
+        self.groups += 1
+        self.reclaimable += group[0][1] * (len(group) - 1)
+        self.conn.executemany(
+            f"INSERT INTO {self.table_duplicates} (group_id, path, fsize, digest) VALUES (?, ?, ?, ?)",
+            [(self.groups, c[0], c[1], digest) for c, digest in zip(group, digests)])
+
+
+def reclaimable_bytes(conn: sqlite3.Connection, table: str = "files") -> int:
+    """
+    Reclaimable byte total of a stored duplicate run
+    """
+    row = conn.execute(f"""
+        SELECT COALESCE(SUM(fsize * (copies - 1)), 0)
+          FROM (SELECT MAX(fsize) AS fsize, COUNT(*) AS copies FROM {table}_duplicates GROUP BY group_id)
+        """).fetchone()
+    return row[0]
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
@@ -3,43 +3,113 @@ OS directory related functions
 """
 
 import base64
+import errno
+import fnmatch
 import hashlib
+import mmap
 import os
 import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from os import listdir
-from os.path import isfile, join, getmtime
-from typing import Optional, Union
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from claar.constants import KB, MB, SECONDS_PER_DAY
+from claar.logger_tools import SCRIPT_LOGGER
+from claar.parsing import match
 
 
 RENAME_LIMIT = 1000  # number limit when renaming file
 NUMBER_OF_STALE_MOUNT_CHECKS = 3
 
 
+def iter_files(local_path: str,
+               pattern: str = None,
+               older_than: float = None,
+               younger_than: float = None,
+               recursive: bool = False,
+               glob: str = None,
+               onerror: Optional[Callable[[OSError], None]] = None) -> Iterator[os.DirEntry]:
+    """
+    Lazily yield the files in a directory as os.DirEntry objects (entry.name, entry.path,
+    entry.stat()). The type comes from the directory listing and every entry is stat'ed
+    at most once, only when an age filter needs it; later entry.stat() calls are cached.
+    :param local_path: path to look for files
+    :param pattern: regular expression searched in the filename
+    :param older_than: only files older than this number of days
+    :param younger_than: only files younger than this number of days
+    :param recursive: also yield the files in subdirectories (symlinked directories are not followed)
+    :param glob: shell-style filename pattern, e.g. "*.csv"
+    :param onerror: called with the error of a subdirectory that cannot be listed, like in os.walk;
+                    by default a warning is logged. The listing then goes on with the other
+                    directories, only an error on local_path itself is raised.
+    """
+    regex = re.compile(pattern) if pattern is not None else None
+    glob_regex = re.compile(fnmatch.translate(glob)) if glob is not None else None
+    now = time.time()
+    max_mtime = now - SECONDS_PER_DAY * older_than if older_than is not None else None
+    min_mtime = now - SECONDS_PER_DAY * younger_than if younger_than is not None else None
+    directories = [local_path]
+    while directories:
+        directory = directories.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError as e:
+            if directory is local_path:
+                raise
+            if onerror is not None:
+                onerror(e)
+            else:
+                SCRIPT_LOGGER.warning(f"Cannot list {directory}: {e}")
+            continue
+        with it:
+            for entry in it:
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                if regex is not None and not regex.search(entry.name):
+                    continue
+                if glob_regex is not None and not glob_regex.match(entry.name):
+                    continue
+                if max_mtime is not None or min_mtime is not None:
+                    mtime = entry.stat().st_mtime
+                    if (max_mtime is not None and mtime > max_mtime) or (min_mtime is not None and mtime < min_mtime):
+                        continue
+                yield entry
+
+
 def list_files(local_path: str,
                pattern: str = None,
                older_than: int = None,
                younger_than: int = None,
-               full_path=True) -> Optional[list]:
+               full_path=True,
+               recursive: bool = False,
+               glob: str = None,
+               sort_by_mtime: bool = False) -> Optional[list]:
     """
-    List the files in a directory
+    List the files in a directory, see iter_files to process large directories lazily
     :param younger_than: list only files younger than this number of days
     :param older_than: list only files older  than this number of days
     :param local_path: path to look for files
     :param pattern: filename pattern to match
     :param full_path: if True the path is added to the filename(s)
+    :param recursive: also list the files in subdirectories, use full_path to tell them apart
+    :param glob: shell-style filename pattern, e.g. "*.csv"
+    :param sort_by_mtime: sort from oldest to newest
     :return: list of  filenames
     """
-    files = [f for f in listdir(local_path) if isfile(join(local_path, f))]
-    if pattern is not None:
-        files = [f for f in files if re.search(pattern, f)]
-    if older_than is not None:
-        files = [f for f in files if getmtime(join(local_path, f)) <= time.time() - 24 * 60 * 60 * older_than]
-    if younger_than is not None:
-        files = [f for f in files if getmtime(join(local_path, f)) >= time.time() - 24 * 60 * 60 * younger_than]
+    entries = iter_files(local_path, pattern, older_than, younger_than, recursive, glob)
+    if sort_by_mtime:
+        entries = sorted(entries, key=lambda entry: entry.stat().st_mtime_ns)
     if full_path:
-        files = [join(local_path, f) for f in files]
-    return files
+        return [entry.path for entry in entries]
+    return [entry.name for entry in entries]
 
 
 def rename_with_date(file_name: str,
@@ -108,13 +178,114 @@ def delete_list(file_list: list, base_dir: str = None) -> bool:
     return ok
 
 
-def file_contents(source_file: str, split: bool = False) -> Union[str, list]:
+CACHE_BYTES = 64 * MB
+
+
+class FileCache:
+    """
+    Process-wide cache of small text files, e.g. configuration, keyed by path.
+
+    An entry is valid as long as (st_mtime_ns, st_size) of the file did not change, which
+    costs one os.stat per read; with a check interval even that is skipped for the given
+    number of seconds after the last check. Least recently used entries are evicted once
+    the cached files together exceed the byte budget. Values derived from the contents,
+    like the lines of load_configfile, are cached with them.
+
+    :ivar hits: reads served from the cache
+    :ivar misses: reads that had to go to the file
+    :ivar evictions: entries dropped for the byte budget
+    """
+
+    def __init__(self, max_bytes: int = CACHE_BYTES, check_interval: float = 0.0) -> None:
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # path -> [mtime_ns, size, checked, contents, derived values]
+        self._lock = threading.Lock()
+
+    def _entry(self, path: str) -> list:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and self.check_interval and now - entry[2] < self.check_interval:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                entry[2] = now
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        with open(path, "r") as f:
+            entry = [st.st_mtime_ns, st.st_size, now, f.read(), {}]
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old[1]
+            if entry[1] <= self.max_bytes:
+                self._entries[path] = entry
+                self.size += entry[1]
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= evicted[1]
+                    self.evictions += 1
+        return entry
+
+    def contents(self, path: str) -> str:
+        """
+        Contents of a text file, read again only when it changed
+        """
+        return self._entry(path)[3]
+
+    def derived(self, path: str, name: str, func: Callable[[str], object]) -> object:
+        """
+        A value computed from the contents by func, computed again only when the file changed
+        """
+        entry = self._entry(path)
+        values = entry[4]
+        if name not in values:
+            values[name] = func(entry[3])
+        return values[name]
+
+    def invalidate(self, path: Optional[str] = None) -> None:
+        """
+        Drop one path, or everything
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self.size = 0
+            elif (entry := self._entries.pop(path, None)) is not None:
+                self.size -= entry[1]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+FILE_CACHE = FileCache()
+
+
+def file_contents(source_file: str, split: bool = False, cached: bool = False) -> Union[str, list]:
     """
     Get the contents of a file.
     :param source_file: file location
     :param split: if True the contents will be split in lines
+    :param cached: serve the contents from FILE_CACHE, the file is only read again when it changed
     :return: String version of the file contents
     """
+    if cached:
+        if split:
+            return list(FILE_CACHE.derived(source_file, "lines", str.splitlines))
+        return FILE_CACHE.contents(source_file)
     f = open(source_file, "r")
     contents = f.read()
     f.close()
@@ -123,13 +294,9 @@ def file_contents(source_file: str, split: bool = False) -> Union[str, list]:
     return contents
 
 
-def load_configfile(source_file: str) -> list:
-    """
-    Load the lines of a text file. Ignore empty lines or lines starting with #
-    """
+def _config_lines(contents: str) -> list:
     ret = []
-    lines = file_contents(source_file, True)
-    for line in lines:
+    for line in contents.splitlines():
         line = line.strip()
         if len(line) == 0 or line.startswith("#"):
             continue
@@ -137,63 +304,594 @@ def load_configfile(source_file: str) -> list:
     return ret
 
 
-def file_prepend(target_file: str, text: str):
+def load_configfile(source_file: str, cached: bool = False) -> list:
     """
-    Add text at the beginning of a file
-    Caution: do not use this with big files
+    Load the lines of a text file. Ignore empty lines or lines starting with #
+    :param cached: parse the file only when it changed, see FileCache
     """
-    with open(target_file, 'r+') as f:
-        content = f.read()
-        f.seek(0, 0)
-        f.write(text + content)
+    if cached:
+        return list(FILE_CACHE.derived(source_file, "config", _config_lines))
+    return _config_lines(file_contents(source_file))
+
+
+COPY_CHUNK = 8 * MB
+BASE64_CHUNK = 3 * MB  # a multiple of 3, so the chunks encode without padding in between
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int, dst_offset: Optional[int] = None) -> int:
+    """
+    Copy a byte range between two open files without passing the data through Python when
+    the platform allows it: os.copy_file_range (in-kernel, reflinks on CoW filesystems),
+    then os.sendfile, then chunked pread/pwrite, or seek/read/write where those do not exist
+    (Windows; the file positions then move as well).
+    :param offset: position in the source
+    :param length: number of bytes to copy
+    :param dst_offset: position in the target, None to write at (and advance) its current position
+    :return: number of bytes copied, less than length if the source ends earlier
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                count = os.copy_file_range(src_fd, dst_fd, min(length - copied, COPY_CHUNK), offset + copied,
+                                           None if dst_offset is None else dst_offset + copied)
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF):
+                raise
+    if dst_offset is None and hasattr(os, "sendfile"):
+        try:
+            while copied < length:
+                count = os.sendfile(dst_fd, src_fd, offset + copied, min(length - copied, COPY_CHUNK))
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+    positioned = hasattr(os, "pread")
+    while copied < length:
+        size = min(length - copied, COPY_CHUNK)
+        if positioned:
+            chunk = os.pread(src_fd, size, offset + copied)
+        else:
+            os.lseek(src_fd, offset + copied, os.SEEK_SET)
+            chunk = os.read(src_fd, size)
+        if not chunk:
+            break
+        if dst_offset is None:
+            os.write(dst_fd, chunk)
+        elif positioned:
+            os.pwrite(dst_fd, chunk, dst_offset + copied)
+        else:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            os.write(dst_fd, chunk)
+        copied += len(chunk)
+    return copied
+
+
+def file_prepend(target_file: str, text: str, encoding: str = "UTF-8"):
+    """
+    Add text at the beginning of a file.
+    The text and the original contents are streamed to a temporary file in the same
+    directory, which then atomically replaces the original, so memory use does not depend
+    on the file size and readers never see a half-written file.
+    A symbolic link is followed: the file it points to is replaced, the link stays.
+    """
+    target = os.path.realpath(target_file)
+    directory, name = os.path.split(target)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+    try:
+        with open(target, "rb", buffering=0) as source:
+            os.write(fd, text.encode(encoding))
+            copy_range(source.fileno(), fd, 0, os.fstat(source.fileno()).st_size)
+        os.close(fd)
+        fd = -1
+        shutil.copymode(target, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if fd >= 0:
+            os.close(fd)
+        os.remove(tmp_path)
+        raise
+
+
+def iter_base64(source_file: str, chunk_size: int = BASE64_CHUNK) -> Iterator[bytes]:
+    """
+    Base64-encode a file incrementally, with constant memory use
+    :param chunk_size: bytes read per step, rounded down to a multiple of 3
+    :return: encoded chunks, their concatenation is the encoding of the whole file
+    """
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    rest = b""
+    with open(source_file, "rb") as f:
+        while chunk := f.read(chunk_size):
+            chunk = rest + chunk
+            aligned = len(chunk) - len(chunk) % 3
+            rest = chunk[aligned:]
+            if aligned:
+                yield base64.b64encode(chunk[:aligned])
+    if rest:
+        yield base64.b64encode(rest)
+
+
+def write_base64(source_file: str, target_file: str) -> int:
+    """
+    Write the base64 encoding of a file to another file, with constant memory use
+    :return: number of bytes written
+    """
+    written = 0
+    with open(target_file, "wb") as f:
+        for chunk in iter_base64(source_file):
+            f.write(chunk)
+            written += len(chunk)
+    return written
 
 
 def file_contents_base64(source_file: str, encoding: str = "UTF-8") -> str:
     """
     Get the contents of a file.
+    For big files use iter_base64 or write_base64, which do not hold the contents in memory.
     :param source_file: file location
     :param encoding: encoding
     :return: String version of the file contents
     """
-    f = open(source_file, "rb")
-    contents = f.read()
-    f.close()
-    return base64.b64encode(contents).decode(encoding)
+    return b"".join(iter_base64(source_file)).decode(encoding)
 
 
 DEFAULT_HASH_CHUNK = 4096
 DEFAULT_HASH_ALGORITHM = "sha256"
 
 
-def update_hash_with_chunks(file, hasher, chunk_size: int) -> None:
+def update_hash_with_chunks(file, hasher, chunk_size: int, limiter=None) -> None:
     """
     Update the hash object by reading the file in chunks.
     :param file: file object opened in binary mode
     :param hasher: hash object to be updated
     :param chunk_size: size of chunks to read from the file
+    :param limiter: optional object with a consume(number_of_bytes) method, e.g. time_tools.RateLimiter
     """
     while chunk := file.read(chunk_size):  # Using the walrus operator for simplicity
+        if limiter is not None:
+            limiter.consume(len(chunk))
         hasher.update(chunk)
 
 
 def file_hash(file_path: str,
               algorithm: str = DEFAULT_HASH_ALGORITHM,
-              chunk_size: int = DEFAULT_HASH_CHUNK) -> Optional[str]:
+              chunk_size: int = DEFAULT_HASH_CHUNK,
+              limiter=None) -> Optional[str]:
     """
     Generate a hash code for the contents of a file.
 
     :param file_path: Path to the target file
     :param algorithm: Hashing algorithm to use (default: sha256)
     :param chunk_size: Size (in bytes) of the file chunks to read (default: 4096)
-    :param log_error: If True, logs the error in case of failure
+    :param limiter: optional bandwidth limiter, see update_hash_with_chunks
     :return: Hash value of the file contents as a hexadecimal string, or None if an error occurred
     """
     hasher = hashlib.new(algorithm)
     with open(file_path, 'rb') as file:
-        update_hash_with_chunks(file, hasher, chunk_size)
+        update_hash_with_chunks(file, hasher, chunk_size, limiter)
     return hasher.hexdigest()
 
 
+HASH_FILES_WORKERS = 8
+HASH_READ_MIN = MB
+HASH_READ_MAX = 8 * MB
+HASH_MMAP_THRESHOLD = 256 * MB  # bigger files are hashed from a memory map
+
+
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM, digest_size: Optional[int] = None):
+    """
+    Create a hash object, with a digest size in bytes for blake2b and blake2s
+    """
+    if digest_size is None:
+        return hashlib.new(algorithm)
+    if algorithm not in ("blake2b", "blake2s"):
+        raise ValueError(f"A digest size is only supported for blake2b and blake2s, not {algorithm}")
+    return hashlib.new(algorithm, digest_size=digest_size)
+
+
+def hash_read_size(fsize: int) -> int:
+    """
+    Read size for hashing a file: big enough to keep the number of system calls low,
+    between 1 and 8 MB, growing with the file
+    """
+    return min(HASH_READ_MAX, max(HASH_READ_MIN, fsize // 16))
+
+
+def hash_file_fast(file_path: str,
+                   algorithm: str = DEFAULT_HASH_ALGORITHM,
+                   digest_size: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Hash a file with large reads, or from a memory map for very large files.
+    hashlib releases the GIL for large updates, so threads hash in parallel.
+    :return: (hex digest, number of bytes hashed)
+    """
+    hasher = new_hasher(algorithm, digest_size)
+    with open(file_path, "rb", buffering=0) as file:
+        fsize = os.fstat(file.fileno()).st_size
+        if fsize >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), HASH_READ_MAX):
+                        hasher.update(view[offset:offset + HASH_READ_MAX])
+            return hasher.hexdigest(), fsize
+        buffer = bytearray(hash_read_size(fsize))
+        hashed = 0
+        with memoryview(buffer) as view:
+            while count := file.readinto(view):
+                hasher.update(view[:count])
+                hashed += count
+    return hasher.hexdigest(), hashed
+
+
+def hash_files(paths: Iterable[str],
+               algorithm: str = DEFAULT_HASH_ALGORITHM,
+               workers: int = HASH_FILES_WORKERS,
+               digest_size: Optional[int] = None) -> Iterator[Tuple[str, Optional[str], int]]:
+    """
+    Hash many files concurrently and yield the results as they complete.
+    At most a few files per worker are in flight, so 'paths' may be a lazy iterator.
+    The aggregate throughput is logged at the end.
+    :param paths: files to hash
+    :param algorithm: hash algorithm, e.g. sha256 or blake2b
+    :param workers: number of threads
+    :param digest_size: digest size in bytes, blake2b/blake2s only
+    :return: tuples (path, hex digest or None if the file could not be read, bytes hashed)
+    """
+    new_hasher(algorithm, digest_size)  # fail early on a bad algorithm or digest size
+    start = time.monotonic()
+    files = total = 0
+
+    def task(path: str) -> Tuple[str, Optional[str], int]:
+        try:
+            return (path,) + hash_file_fast(path, algorithm, digest_size)
+        except OSError:
+            return path, None, 0
+
+    with ThreadPoolExecutor(workers) as pool:
+        running = set()
+        for path in paths:
+            if len(running) >= workers * 4:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files += 1
+                    total += future.result()[2]
+                    yield future.result()
+            running.add(pool.submit(task, path))
+        for future in as_completed(running):
+            files += 1
+            total += future.result()[2]
+            yield future.result()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    SCRIPT_LOGGER.info(f"Hashed {files} files, {total / MB:.1f} MB in {elapsed:.1f}s ({total / MB / elapsed:.1f} MB/s)")
+
+
+COPY_WORKERS = 4  # files copied at the same time
+COPY_RANGE_WORKERS = 4  # parallel ranges of one large file
+COPY_PARALLEL = 256 * MB  # files from this size on are copied in parallel ranges
+COPY_RANGE = 64 * MB
+
+
+class CopyResult(NamedTuple):
+    source: str
+    target: str
+    size: int
+    seconds: float
+    digest: Optional[str] = None  # digest of the source, if the copy was verified
+    ok: bool = True  # False if the copy failed or its verification failed
+    error: Optional[Exception] = None  # why the copy failed, see copy_files
+
+
+def copy_file(source: str,
+              target: str,
+              range_pool: Optional[ThreadPoolExecutor] = None,
+              verify: Optional[str] = None) -> CopyResult:
+    """
+    Copy one file with copy_range, into a temporary file next to the target that replaces
+    it atomically at the end; mode and timestamps are copied too. Files of at least
+    COPY_PARALLEL bytes are split in ranges that are copied in 'range_pool'.
+    :param verify: hash algorithm to compare source and copy with afterwards, None for no check
+    """
+    start = time.monotonic()
+    directory, name = os.path.split(os.path.abspath(target))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+    try:
+        with open(source, "rb", buffering=0) as src:
+            src_fd = src.fileno()
+            size = os.fstat(src_fd).st_size
+            if range_pool is not None and size >= COPY_PARALLEL:
+                os.ftruncate(fd, size)
+                futures = [range_pool.submit(copy_range, src_fd, fd, offset, min(COPY_RANGE, size - offset), offset)
+                           for offset in range(0, size, COPY_RANGE)]
+                copied = sum(future.result() for future in futures)
+            else:
+                copied = copy_range(src_fd, fd, 0, size)
+        if copied != size:
+            raise OSError(f"{source} changed while copying: {copied} of {size} bytes copied")
+        os.close(fd)
+        fd = -1
+        shutil.copystat(source, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if fd >= 0:
+            os.close(fd)
+        os.remove(tmp_path)
+        raise
+    digest, ok = None, True
+    if verify is not None:
+        digest = hash_file_fast(source, verify)[0]
+        ok = hash_file_fast(target, verify)[0] == digest
+        if not ok:
+            SCRIPT_LOGGER.error(f"Copy of {source} to {target} differs from the source")
+    return CopyResult(source, target, size, time.monotonic() - start, digest, ok)
+
+
+def copy_files(files: Iterable[Tuple[str, str]],
+               workers: int = COPY_WORKERS,
+               range_workers: int = COPY_RANGE_WORKERS,
+               verify: Optional[str] = None) -> List[CopyResult]:
+    """
+    Copy many files at device speed: the data is copied in the kernel where possible
+    (see copy_range), 'workers' files at once, and large files in parallel ranges.
+    At most a few files per worker are in flight, so 'files' may be a lazy iterator.
+    A failing copy does not stop the others, its result has ok False and the error.
+    The aggregate throughput is logged at the end.
+    :param files: (source, target) pairs, a target is a file path, not a directory
+    :param workers: max number of files copied at the same time
+    :param range_workers: max number of ranges of large files copied at the same time
+    :param verify: hash algorithm to verify every copy with, None for no verification
+    :return: a CopyResult per file, in the order they finished
+    """
+    start = time.monotonic()
+    results = []
+
+    def task(source: str, target: str, range_pool: ThreadPoolExecutor) -> CopyResult:
+        try:
+            return copy_file(source, target, range_pool, verify)
+        except Exception as e:
+            SCRIPT_LOGGER.error(f"Copy of {source} to {target} failed: {e}")
+            return CopyResult(source, target, 0, 0.0, ok=False, error=e)
+
+    with ThreadPoolExecutor(range_workers) as range_pool, ThreadPoolExecutor(workers) as pool:
+        running = set()
+        for source, target in files:
+            if len(running) >= workers * 4:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                results += [future.result() for future in done]
+            running.add(pool.submit(task, source, target, range_pool))
+        results += [future.result() for future in as_completed(running)]
+    elapsed = max(time.monotonic() - start, 1e-9)
+    copied = [result for result in results if result.error is None]
+    total = sum(result.size for result in copied)
+    SCRIPT_LOGGER.info(f"Copied {len(copied)} files, {total / MB:.1f} MB in {elapsed:.1f}s "
+                       f"({total / MB / elapsed:.1f} MB/s)"
+                       + (f", {len(results) - len(copied)} failed" if len(copied) < len(results) else ""))
+    return results
+
+
+SEARCH_WORKERS = os.cpu_count() or 1
+
+
+def compile_bytes_patterns(patterns: Iterable[Union[str, bytes, re.Pattern]]) -> List[re.Pattern]:
+    """
+    Compile search patterns to bytes regular expressions, for searching raw file contents.
+    str patterns are UTF-8 encoded, compiled patterns keep their flags except re.UNICODE.
+    """
+    compiled = []
+    for pattern in patterns:
+        flags = 0
+        if isinstance(pattern, re.Pattern):
+            flags = pattern.flags & ~re.UNICODE
+            pattern = pattern.pattern
+        if isinstance(pattern, str):
+            pattern = pattern.encode("utf-8")
+        compiled.append(re.compile(pattern, flags | re.MULTILINE))
+    return compiled
+
+
+def search_file(path: str, regexps: List[re.Pattern], encoding: str = "UTF-8") -> List[Tuple[str, int, str]]:
+    """
+    All lines of a file that match one of the bytes regexps (parsing.match semantics).
+    The file is memory-mapped and every pattern scans it in one pass; only for the hits the
+    line is cut out and its number counted.
+    :return: (path, line number starting at 1, line without line end) per matching line, in file order
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return []
+    with data:
+        starts = set()
+        for regexp in regexps:
+            position = 0
+            while (found := regexp.search(data, position)) is not None:
+                line_start = data.rfind(b"\n", 0, found.start()) + 1
+                line_end = data.find(b"\n", found.start())
+                line_end = len(data) if line_end < 0 else line_end
+                starts.add((line_start, line_end))
+                position = line_end + 1
+                if position > len(data):
+                    break
+        hits = []
+        line_no, counted = 1, 0
+        for line_start, line_end in sorted(starts):
+            line = data[line_start:line_end]
+            if not match(line, regexps):  # the hit spanned more than this line
+                continue
+            line_no += data[counted:line_start].count(b"\n")
+            counted = line_start
+            hits.append((path, line_no, line.rstrip(b"\r").decode(encoding, errors="replace")))
+    return hits
+
+
+def search_files(paths: Iterable[str],
+                 patterns: Iterable[Union[str, bytes, re.Pattern]],
+                 workers: int = SEARCH_WORKERS,
+                 encoding: str = "UTF-8") -> Iterator[Tuple[str, int, str]]:
+    """
+    Search files for lines matching any of the patterns, like grep -E with several -e options.
+    Files are spread over a process pool; the matches are yielded lazily, file by file as
+    the files are done, and in line order within a file. Unreadable files are skipped.
+    :param paths: files to search
+    :param patterns: regular expressions (str, bytes or compiled), a line matches if one of them is found
+    :param workers: number of processes
+    :param encoding: encoding to decode the matching lines with
+    :return: (path, line number starting at 1, line) per matching line
+    """
+    regexps = compile_bytes_patterns(patterns)
+    if not regexps:
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        running = set()
+        for path in paths:
+            if len(running) >= workers * 4:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            running.add(pool.submit(search_file, path, regexps, encoding))
+        for future in as_completed(running):
+            yield from future.result()
+
+
+LINE_COUNT_CHUNK = 8 * MB
+LINE_COUNT_PARALLEL = 256 * MB  # files from this size on are counted in parallel byte ranges
+LINE_COUNT_WORKERS = os.cpu_count() or 1
+
+
+def count_newlines(file_path: str, start: int = 0, end: Optional[int] = None) -> int:
+    """
+    Count the newline bytes in a byte range of a file, reading large binary chunks
+    :param start: first byte of the range
+    :param end: end of the range (exclusive), None for the end of the file
+    """
+    count = 0
+    buffer = bytearray(LINE_COUNT_CHUNK)
+    with open(file_path, "rb", buffering=0) as file:
+        file.seek(start)
+        remaining = end - start if end is not None else None
+        with memoryview(buffer) as view:
+            while remaining is None or remaining > 0:
+                size = file.readinto(view if remaining is None or remaining >= len(buffer) else view[:remaining])
+                if not size:
+                    break
+                count += buffer.count(b"\n", 0, size)
+                if remaining is not None:
+                    remaining -= size
+    return count
+
+
+def count_lines(file_path: str,
+                workers: int = LINE_COUNT_WORKERS,
+                parallel_threshold: int = LINE_COUNT_PARALLEL) -> int:
+    """
+    Count the lines of a file without decoding it. A last line without line end counts too.
+    Files of at least 'parallel_threshold' bytes are split in byte ranges that are counted
+    in a process pool (counting bytes holds the GIL, reading does not need it).
+    Only a newline byte ends a line, a bare carriage return (old Mac files) does not.
+    """
+    fsize = os.path.getsize(file_path)
+    if fsize == 0:
+        return 0
+    if fsize < parallel_threshold or workers <= 1:
+        count = count_newlines(file_path)
+    else:
+        step = -(-fsize // workers)
+        starts = range(0, fsize, step)
+        with ProcessPoolExecutor(workers) as pool:
+            count = sum(pool.map(count_newlines, [file_path] * len(starts), starts,
+                                 [min(start + step, fsize) for start in starts]))
+    with open(file_path, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b"\n":
+            count += 1
+    return count
+
+
+LINE_ALIGN_BLOCK = 64 * KB
+
+
+def line_ranges(file_path: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    Split a file into at most 'parts' byte ranges of about equal size that start and end on
+    line boundaries. Only the bytes around each split point are read.
+    :return: [start, end) byte ranges that together cover the file
+    """
+    fsize = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, "rb") as f:
+        for part in range(1, max(1, parts)):
+            # a range starts right after the first line end at or after the nominal split point
+            position = max(part * fsize // parts, bounds[-1])
+            while position < fsize:
+                f.seek(position)
+                block = f.read(LINE_ALIGN_BLOCK)
+                found = block.find(b"\n")
+                if found >= 0:
+                    position += found + 1
+                    break
+                position += len(block)
+            if position >= fsize:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(fsize)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def iter_range_lines(file_path: str, start: int, end: int, encoding: Optional[str] = "UTF-8") -> Iterator:
+    """
+    Iterate over the lines in a byte range from line_ranges, line ends included
+    :param encoding: encoding to decode the lines with, None to yield bytes
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line if encoding is None else line.decode(encoding)
+
+
+def _map_range(func: Callable, file_path: str, start: int, end: int, encoding: Optional[str]) -> list:
+    return [func(line) for line in iter_range_lines(file_path, start, end, encoding)]
+
+
+def map_file_lines(func: Callable,
+                   file_path: str,
+                   workers: int = LINE_COUNT_WORKERS,
+                   encoding: Optional[str] = "UTF-8") -> list:
+    """
+    Apply func to every line of a file in a process pool, one line-aligned byte range per
+    worker, and return the results in file order. func has to be picklable, i.e. defined
+    at module level.
+    :param func: function called with one line (line end included)
+    :param encoding: encoding to decode the lines with, None to pass bytes
+    """
+    ranges = line_ranges(file_path, workers)
+    if len(ranges) <= 1:
+        return [result for start, end in ranges for result in _map_range(func, file_path, start, end, encoding)]
+    results = []
+    with ProcessPoolExecutor(workers) as pool:
+        for part in pool.map(_map_range, [func] * len(ranges), [file_path] * len(ranges),
+                             [start for start, _ in ranges], [end for _, end in ranges], [encoding] * len(ranges)):
+            results += part
+    return results
+
+
 def get_line_count(file_path: str) -> Optional[int]:
     """
     Counts the number of lines in the given file.
@@ -201,11 +899,7 @@ def get_line_count(file_path: str) -> Optional[int]:
     :param file_path: Path to the input file
     :return: Number of lines in the file, or None if an error occurs
     """
-    line_count = 0  # Initialize line count
-    with open(file_path, 'rt') as file:
-        for line_count, _ in enumerate(file, start=1):  # Start count at 1
-            pass
-    return line_count
+    return count_lines(file_path)
 
 
 def peek_line(infile, strip: bool = True) -> Optional[str]:
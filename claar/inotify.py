@@ -0,0 +1,122 @@
+"""
+Minimal Linux inotify binding on top of ctypes, no external dependencies
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from dataclasses import dataclass
+from typing import List, Optional
+
+# event masks, see inotify(7)
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = getattr(os, "O_NONBLOCK", 0)  # the os flags only exist on Unix, Inotify() fails elsewhere
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+# everything that changes the facts of the files in a directory
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+
+@dataclass
+class Event:
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """
+    An inotify instance. Use as a context manager, or call close().
+    """
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        except OSError:
+            self._libc = None
+        if self._libc is None or not hasattr(self._libc, "inotify_init1"):
+            self.fd = -1
+            raise OSError("inotify is not available on this platform")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+    def __enter__(self) -> "Inotify":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path: str, mask: int = IN_CHANGES) -> int:
+        """
+        Watch a path
+        :return: watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch {path} failed: {os.strerror(errno)}")
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """
+        Stop watching, errors are ignored (the watch may already be gone)
+        """
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: Optional[float] = None) -> List[Event]:
+        """
+        Wait at most 'timeout' seconds for events and return all events that are available
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append(Event(wd, mask, cookie, name))
+        return events
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
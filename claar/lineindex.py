@@ -0,0 +1,124 @@
+"""
+Line-offset index for huge text files
+
+The index holds the byte offset of the start of every line, plus the end of the file.
+It is stored next to the file as {file}.lineidx, together with the size and mtime of the
+file, and rebuilt automatically when the file changed. With it, line N is one pread away
+and a file can be split into ranges with an equal number of lines.
+"""
+import os
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from claar.filesystem import LINE_COUNT_CHUNK
+
+INDEX_SUFFIX = ".lineidx"
+INDEX_MAGIC = b"CLLIDX1\0"
+INDEX_HEADER = struct.Struct("<8sQqQ")  # magic, file size, mtime_ns, number of lines
+
+
+def line_offsets(file_path: str) -> np.ndarray:
+    """
+    Offsets of the starts of all lines, followed by the file size, found with NumPy over
+    large binary chunks
+    """
+    found = [np.zeros(1, dtype="<u8")]
+    position = 0
+    with open(file_path, "rb", buffering=0) as file:
+        while chunk := file.read(LINE_COUNT_CHUNK):
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            found.append((newlines + position + 1).astype("<u8"))
+            position += len(chunk)
+    offsets = np.concatenate(found)
+    if offsets[-1] != position:  # last line without line end
+        offsets = np.append(offsets, np.array([position], dtype="<u8"))
+    return offsets
+
+
+class LineIndex:
+    """
+    Random access to the lines of a file
+
+    :ivar offsets: start offset of every line, the last element is the file size
+    """
+
+    def __init__(self, file_path: str, index_path: Optional[str] = None, persist: bool = True) -> None:
+        """
+        :param file_path: text file to index
+        :param index_path: location of the index, default {file_path}.lineidx
+        :param persist: load the index from disk if it is still valid, write it after a rebuild
+        """
+        self.file_path = file_path
+        self.index_path = index_path or file_path + INDEX_SUFFIX
+        st = os.stat(file_path)
+        self.offsets = self._load(st) if persist else None
+        if self.offsets is None:
+            self.offsets = line_offsets(file_path)
+            if persist:
+                self._save(st)
+        self._fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def _load(self, st: os.stat_result) -> Optional[np.ndarray]:
+        try:
+            with open(self.index_path, "rb") as f:
+                magic, fsize, mtime_ns, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if magic != INDEX_MAGIC or fsize != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        return np.memmap(self.index_path, dtype="<u8", mode="r", offset=INDEX_HEADER.size, shape=(count + 1,))
+
+    def _save(self, st: os.stat_result) -> None:
+        tmp_path = f"{self.index_path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(self)))
+            self.offsets.tofile(f)
+        os.replace(tmp_path, self.index_path)
+
+    def __enter__(self) -> "LineIndex":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, n: int) -> bytes:
+        """
+        Line n (0-based), including its line end
+        """
+        if not 0 <= n < len(self):
+            raise IndexError(f"Line {n} out of range, {self.file_path} has {len(self)} lines")
+        start, end = int(self.offsets[n]), int(self.offsets[n + 1])
+        return os.pread(self._fd, end - start, start)
+
+    def lines(self, first: int, last: int) -> bytes:
+        """
+        Lines [first, last) in one read
+        """
+        first, last = max(0, first), min(len(self), last)
+        if first >= last:
+            return b""
+        start, end = int(self.offsets[first]), int(self.offsets[last])
+        return os.pread(self._fd, end - start, start)
+
+    def split(self, parts: int) -> List[Tuple[int, int, int, int]]:
+        """
+        Split the file into ranges with an equal number of lines, for parallel processing
+        :return: (first line, end line, start byte, end byte) per range, ends are exclusive
+        """
+        bounds = np.linspace(0, len(self), max(1, parts) + 1).astype(int)
+        return [(int(first), int(last), int(self.offsets[first]), int(self.offsets[last]))
+                for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
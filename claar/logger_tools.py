@@ -5,7 +5,7 @@ import inspect
 import logging
 from dataclasses import dataclass
 from typing import Union
-from ansi import RED, BLUE, GREEN, WHITE, RESET, BRIGHT_RED
+from claar.ansi import RED, BLUE, GREEN, WHITE, RESET, BRIGHT_RED
 
 APPLICATION_LOGGER_NAME = "CENTRAL_LOGGER"
 
@@ -0,0 +1,230 @@
+"""
+Scan many roots at once with claar.scan.FileScanner
+
+Every root is scanned in its own process into its own shard database, so the scans never
+wait for each other's write lock. The shards keep the generations, change logs and caches
+of their root, which keeps successive runs incremental. As soon as a shard is finished,
+the coordinator merges its inventory into the main database with ATTACH and set-based SQL,
+while the other roots are still being scanned.
+"""
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from claar.scan import (HASHES_DEF, PROGRESS_INTERVAL, TABLE_DEF, FileScanner, TreeWalker, normalize_path,
+                        path_range)
+from claar.sqlite import create_table, datetime_to_sqlite
+
+SHARDS_DEF = """
+    root TEXT PRIMARY KEY,
+    shard TEXT NOT NULL,
+    generation INTEGER,
+    files INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    merged TEXT NOT NULL
+"""
+
+INVENTORY_COLUMNS = "path, fsize, mtime_ns, mode, dev, inode, info, digest, generation"
+
+_progress_queue = None  # set in every worker process by _init_worker
+
+
+def shard_name(root: str) -> str:
+    """
+    File name of the shard database of a root
+    """
+    return hashlib.sha1(root.encode()).hexdigest()[:16] + ".db"
+
+
+def _init_worker(progress_queue) -> None:
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _report(root: str, walker: TreeWalker, state: str) -> None:
+    if _progress_queue is not None:
+        _progress_queue.put((root, state, walker.files, walker.files_per_second, walker.queue_depth, walker.errors))
+
+
+def scan_shard(root: str, shard_path: str, table: str, options: dict) -> tuple:
+    """
+    Scan one root into its shard database, runs in a worker process.
+    The report of the scanner is suppressed, progress goes to the coordinator instead.
+    :return: (root, shard path, result of FileScanner.scan, generation, seconds)
+    """
+    start = time.monotonic()
+    scanner = FileScanner(root, shard_path, table,
+                          progress=lambda walker: _report(root, walker, "walking"), **options)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = scanner.scan()
+    return root, shard_path, result, scanner.generation if scanner.completed else None, time.monotonic() - start
+
+
+class MultiRootScanner:
+    """
+    Scan a list of roots in parallel processes and merge them into one inventory.
+
+    The roots should not overlap. The main database gets the inventory table (same layout
+    as the one of FileScanner), the hash cache and {table}_shards with the last merge of
+    every root. Generations and change logs stay in the shards.
+
+    :ivar results: root -> result of FileScanner.scan in its shard (None if it did not finish)
+    :ivar failed: root -> error of the roots whose scan raised an exception
+    """
+
+    def __init__(self,
+                 roots: List[str],
+                 db_path: str,
+                 table: str = "files",
+                 processes: Optional[int] = None,
+                 shard_dir: Optional[str] = None,
+                 **options) -> None:
+        """
+        :param roots: directories to scan
+        :param db_path: main database the shards are merged into
+        :param processes: number of parallel scans, default one per root up to the number of CPUs
+        :param shard_dir: directory of the shard databases, default {db_path}.shards
+        :param options: passed to every FileScanner, e.g. workers, hash_algorithm, prune
+        """
+        self.roots = [normalize_path(root) for root in roots]
+        self.db_path = db_path
+        self.table = table
+        self.table_hashes = f"{table}_hashes"
+        self.table_shards = f"{table}_shards"
+        self.processes = processes or max(1, min(len(self.roots), os.cpu_count() or 1))
+        self.shard_dir = shard_dir or f"{db_path}.shards"
+        self.options = options
+        self.results: Dict[str, Optional[int]] = {}
+        self.failed: Dict[str, BaseException] = {}
+        self.state: Dict[str, tuple] = {root: ("queued", 0, 0.0, 0, 0) for root in self.roots}
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        for name, definition in [(table, f"{TABLE_DEF}, generation INTEGER NOT NULL"),
+                                 (self.table_hashes, HASHES_DEF),
+                                 (self.table_shards, SHARDS_DEF)]:
+            ok, err = create_table(self.conn, name, definition, drop=False, create_if_exists=True)
+            if not ok:
+                raise RuntimeError(f"Kon de tabel {name} niet aanmaken of openen: {err}")
+        self.conn.commit()
+
+    def run(self) -> Dict[str, Optional[int]]:
+        """
+        Scan all roots and merge every shard as soon as it is ready
+        :return: root -> result of its scan
+        """
+        start = last_report = time.monotonic()
+        progress = multiprocessing.Queue()
+        with ProcessPoolExecutor(self.processes, initializer=_init_worker, initargs=(progress,)) as pool:
+            futures = {pool.submit(scan_shard, root, os.path.join(self.shard_dir, shard_name(root)),
+                                   self.table, self.options): root
+                       for root in self.roots}
+            running = set(futures)
+            while running:
+                done, running = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                self._drain(progress)
+                for future in done:
+                    root = futures[future]
+                    try:
+                        _, shard_path, result, generation, seconds = future.result()
+                    except Exception as e:
+                        self.failed[root] = e
+                        self.state[root] = ("failed",) + self.state[root][1:]
+                        continue
+                    self.results[root] = result
+                    if generation is None:
+                        self.state[root] = ("paused",) + self.state[root][1:]
+                        continue
+                    files = self.merge(root, shard_path, generation, seconds)
+                    self.state[root] = ("merged", files, 0.0, 0, self.state[root][4])
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    self.report(now - start)
+        progress.close()
+        self.report(time.monotonic() - start)
+        for root, error in self.failed.items():
+            print(f"Scan of {root} failed: {error}")
+        self.conn.close()
+        return self.results
+
+    def _drain(self, progress) -> None:
+        while True:
+            try:
+                root, state, files, files_per_second, queued, errors = progress.get_nowait()
+            except queue.Empty:
+                return
+            if self.state[root][0] in ("queued", "walking"):
+                self.state[root] = (state, files, files_per_second, queued, errors)
+
+    def report(self, elapsed: float) -> None:
+        """
+        Print one combined progress line for all roots, and the root that is furthest behind
+        """
+        counts: Dict[str, int] = {}
+        for state, *_ in self.state.values():
+            counts[state] = counts.get(state, 0) + 1
+        files = sum(state[1] for state in self.state.values())
+        rate = sum(state[2] for state in self.state.values() if state[0] == "walking")
+        line = f"{elapsed:.0f}s: {files} files ({rate:.0f} files/s), " + \
+            ", ".join(f"{count} {state}" for state, count in sorted(counts.items()))
+        walking = [(root, state) for root, state in self.state.items() if state[0] == "walking"]
+        if walking:
+            root, state = max(walking, key=lambda item: item[1][3])
+            line += f"; most directories queued: {root} ({state[3]})"
+        print(line)
+
+    def merge(self, root: str, shard_path: str, generation: int, seconds: float) -> int:
+        """
+        Bring the part of the main inventory below root in line with its shard: rows that
+        disappeared are deleted, only new and changed rows are written.
+        :return: number of files of the root
+        """
+        lo, hi = path_range(root)
+        params = {"lo": lo, "hi": hi}
+        self.conn.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        try:
+            self.conn.execute(f"""
+                DELETE FROM main.{self.table}
+                 WHERE path >= :lo AND path < :hi
+                   AND NOT EXISTS (SELECT 1 FROM shard.{self.table} s WHERE s.path = main.{self.table}.path)
+                """, params)
+            self.conn.execute(f"""
+                INSERT OR REPLACE INTO main.{self.table} ({INVENTORY_COLUMNS})
+                SELECT {INVENTORY_COLUMNS}
+                  FROM shard.{self.table} s
+                 WHERE s.path >= :lo AND s.path < :hi
+                   AND NOT EXISTS (SELECT 1 FROM main.{self.table} m
+                                    WHERE m.path = s.path AND m.fsize IS s.fsize AND m.mtime_ns IS s.mtime_ns
+                                      AND m.mode IS s.mode AND m.dev IS s.dev AND m.inode IS s.inode
+                                      AND m.info IS s.info AND m.digest IS s.digest)
+                """, params)
+            self.conn.execute(f"""
+                INSERT OR REPLACE INTO main.{self.table_hashes} (dev, inode, algorithm, fsize, mtime_ns, digest)
+                SELECT dev, inode, algorithm, fsize, mtime_ns, digest
+                  FROM shard.{self.table_hashes} s
+                 WHERE NOT EXISTS (SELECT 1 FROM main.{self.table_hashes} m
+                                    WHERE m.dev = s.dev AND m.inode = s.inode AND m.algorithm = s.algorithm
+                                      AND m.fsize = s.fsize AND m.mtime_ns = s.mtime_ns AND m.digest = s.digest)
+                """)
+            files = self.conn.execute(
+                f"SELECT COUNT(*) FROM main.{self.table} WHERE path >= :lo AND path < :hi", params).fetchone()[0]
+            self.conn.execute(f"INSERT OR REPLACE INTO {self.table_shards} VALUES (?, ?, ?, ?, ?, ?)",
+                              (root, shard_path, generation, files, seconds, datetime_to_sqlite(datetime.now())))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.execute("DETACH DATABASE shard")
+        return files
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
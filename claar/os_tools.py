@@ -1,14 +1,39 @@
 """
 OS
 """
+import os
+import threading
+import time
+from collections import deque
+from time import sleep
+from typing import Dict, Optional, Tuple
 
-from os import getloadavg
-from time_tools import sleep
+from claar import time_tools
+from claar.constants import MB
+from claar.logger_tools import SCRIPT_LOGGER
+from claar.time_tools import RateLimiter
 
 LOAD_LOOP_DELAY = 1  # number of seconds to sleep during loop to sync
 LOAD_LOOP_MAX = 1000  # max number of loops to wait until syc wait breaks
 LOAD_DEFAULT_THRESHOLD = 4  # load avg
 
+IO_PRESSURE_FILE = "/proc/pressure/io"
+IO_PRESSURE_THRESHOLD = 10.0  # % of the time tasks were stalled on I/O during the last 10 seconds
+THROTTLE_INTERVAL = 1.0  # min number of seconds between two samples
+THROTTLE_RELAX_RATIO = 0.7  # load and pressure must drop below this part of the threshold to speed up again
+THROTTLE_RATE_STEP = 1.5  # factor to raise the byte rate with when the server is quiet
+THROTTLE_MIN_RATE = MB  # bytes/s
+THROTTLE_HISTORY = 1000  # number of decisions kept
+
+try:
+    from os import getloadavg
+except ImportError:
+    def getloadavg() -> Tuple[float, float, float]:
+        """
+        Windows has no load average, report an idle server so waiting and throttling on the load never block
+        """
+        return 0.0, 0.0, 0.0
+
 
 def get_avg_load_01():
     """
@@ -57,12 +82,185 @@ def wait_for_load(threshold: float = LOAD_DEFAULT_THRESHOLD,
     """
     SCRIPT_LOGGER.debug(f"Checking if server load is below {threshold}.")
     i = 0
-    start_epoch = time_tools.get_epoch_now()
+    start_epoch = time_tools.get_epoch()
     while i < max_iterations and get_avg_load_1() >= threshold:
         i += 1
         SCRIPT_LOGGER.warning(f"Load is too high, sleeping {delay} seconds")
         sleep(delay)
-    return time_tools.get_epoch_now() - start_epoch
+    return time_tools.get_epoch() - start_epoch
+
+
+def io_pressure() -> Optional[float]:
+    """
+    Share of the last 10 seconds (in %) that some tasks were stalled waiting for I/O,
+    from the pressure stall information of the kernel
+    :return: percentage or None if the kernel does not offer it
+    """
+    try:
+        with open(IO_PRESSURE_FILE) as f:
+            for line in f:
+                if line.startswith("some "):
+                    return float(line.split()[1].split("=")[1])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+class LoadThrottle:
+    """
+    Adaptive throttle for background jobs on shared servers.
+
+    update() samples the load average and the I/O pressure at most once per interval.
+    When either one reaches its threshold, the number of workers and the byte rate are
+    halved; when both are well below it, one worker is added and the rate is raised step
+    by step, until the maxima are reached again. If the server stays overloaded while the
+    throttle is already at its minimum, update() blocks until neither the load average
+    nor the I/O pressure is at its threshold anymore (see wait).
+
+    A RateLimiter passed as 'limiter' follows the rate; without a maximum rate the limiter
+    starts unlimited and is throttled from the throughput it actually measured.
+
+    :ivar workers: number of workers currently allowed
+    :ivar rate: bytes/s currently allowed, None for unlimited
+    :ivar decisions: the last decisions as (epoch, load, io pressure, workers, rate, action)
+    """
+
+    def __init__(self,
+                 max_workers: int,
+                 max_rate: Optional[float] = None,
+                 min_workers: int = 1,
+                 min_rate: float = THROTTLE_MIN_RATE,
+                 load_threshold: Optional[float] = None,
+                 pressure_threshold: float = IO_PRESSURE_THRESHOLD,
+                 interval: float = THROTTLE_INTERVAL,
+                 limiter: Optional[RateLimiter] = None) -> None:
+        self.max_workers = max(1, max_workers)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.load_threshold = load_threshold if load_threshold is not None else float(os.cpu_count() or 1)
+        self.pressure_threshold = pressure_threshold
+        self.interval = interval
+        self.workers = self.max_workers
+        self.rate = max_rate
+        self.load = 0.0
+        self.pressure: Optional[float] = None
+        self.samples = 0
+        self.throttled = 0
+        self.relaxed = 0
+        self.waited = 0.0
+        self.decisions = deque(maxlen=THROTTLE_HISTORY)
+        self._limiter = None
+        self._lock = threading.Lock()
+        self._last_sample = None
+        self._last_consumed = 0
+        self.attach(limiter)
+
+    def attach(self, limiter: Optional[RateLimiter]) -> None:
+        """
+        Let a rate limiter follow the rate of this throttle
+        """
+        self._limiter = limiter
+        if limiter is not None:
+            limiter.rate = self.rate
+            self._last_consumed = limiter.consumed
+
+    def overloaded(self) -> bool:
+        return self.load >= self.load_threshold or \
+            (self.pressure is not None and self.pressure >= self.pressure_threshold)
+
+    def quiet(self) -> bool:
+        return self.load < self.load_threshold * THROTTLE_RELAX_RATIO and \
+            (self.pressure is None or self.pressure < self.pressure_threshold * THROTTLE_RELAX_RATIO)
+
+    def update(self) -> int:
+        """
+        Sample the server when the interval passed and adapt workers and rate
+        :return: number of workers currently allowed
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._last_sample is not None and now - self._last_sample < self.interval:
+                return self.workers
+            elapsed = now - self._last_sample if self._last_sample is not None else None
+            self._last_sample = now
+            self.load = get_avg_load_1()
+            self.pressure = io_pressure()
+            self.samples += 1
+            throughput = None
+            if self._limiter is not None:
+                consumed = self._limiter.consumed
+                if elapsed:
+                    throughput = (consumed - self._last_consumed) / elapsed
+                self._last_consumed = consumed
+            if self.overloaded():
+                rate_at_min = self.rate <= self.min_rate if self.rate is not None else throughput is None
+                if self.workers == self.min_workers and rate_at_min:
+                    action = "wait"
+                else:
+                    action = "throttle"
+                    self.throttled += 1
+                    self.workers = max(self.min_workers, self.workers // 2)
+                    current = self.rate if self.rate is not None else throughput
+                    if current is not None:
+                        self.rate = max(self.min_rate, current / 2)
+            elif self.quiet() and (self.workers < self.max_workers or self.rate != self.max_rate):
+                action = "relax"
+                self.relaxed += 1
+                self.workers = min(self.max_workers, self.workers + 1)
+                if self.rate is not None:
+                    self.rate *= THROTTLE_RATE_STEP
+                    if self.max_rate is not None:
+                        self.rate = min(self.rate, self.max_rate)
+                    elif throughput is not None and throughput < self.rate / THROTTLE_RATE_STEP:
+                        # the limiter does not hold anything back anymore
+                        self.rate = None
+            else:
+                action = "keep"
+            if self._limiter is not None:
+                self._limiter.rate = self.rate
+            self.decisions.append((time_tools.get_epoch(), self.load, self.pressure, self.workers, self.rate, action))
+        if action == "wait":
+            SCRIPT_LOGGER.warning(f"Server stays overloaded (load {self.load:.1f}, io pressure {self.pressure}), "
+                                  f"waiting.")
+            self.waited += self.wait(max_iterations=max(1, int(self.interval * 60)))
+        return self.workers
+
+    def wait(self, delay: float = LOAD_LOOP_DELAY, max_iterations: int = LOAD_LOOP_MAX) -> float:
+        """
+        Sleep until the server is no longer overloaded, on the same condition update() uses:
+        the load average or the I/O pressure at its threshold
+        :param delay: number of seconds to sleep between samples
+        :param max_iterations: max number of samples
+        :return: number of seconds waited
+        """
+        start = time.monotonic()
+        for _ in range(max_iterations):
+            if not self.overloaded():
+                break
+            sleep(delay)
+            with self._lock:
+                self.load = get_avg_load_1()
+                self.pressure = io_pressure()
+        return time.monotonic() - start
+
+    def metrics(self) -> Dict[str, Optional[float]]:
+        """
+        Current state and decision counters, for progress reports and monitoring
+        """
+        return {"load": self.load,
+                "io_pressure": self.pressure,
+                "workers": self.workers,
+                "rate": self.rate,
+                "samples": self.samples,
+                "throttled": self.throttled,
+                "relaxed": self.relaxed,
+                "waited": self.waited}
+
+    def __repr__(self) -> str:
+        rate = "unlimited" if self.rate is None else f"{self.rate / MB:.1f} MB/s"
+        pressure = "n/a" if self.pressure is None else f"{self.pressure:.1f}%"
+        return f"load {self.load:.2f}, io pressure {pressure}: {self.workers} workers, {rate}"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+"""
+Sorted, memory-mapped path index exported from the inventory of claar.scan.FileScanner
+
+Layout of the index file (native byte order, recorded in the magic):
+    header      magic (8 bytes), count, blob size, generation (3 x uint64)
+    offsets     count + 1 x uint64, file position of every path in the blob and the end of the blob
+    fsize       count x int64
+    mtime_ns    count x int64
+    dev         count x uint64
+    inode       count x uint64
+    mode        count x uint32
+    blob        the UTF-8 encoded paths, sorted bytewise
+
+Lookups are binary searches on the memory map, so nothing is loaded at open time and
+any number of processes share the same pages of the page cache. An export is written
+to a temporary file and renamed, readers that still have the old index open keep it.
+"""
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+from typing import Iterator, Optional, Tuple, Union
+
+from claar.scan import Fact, normalize_path, path_range
+
+MAGIC = b"CLPIDX1" + (b"L" if sys.byteorder == "little" else b"B")
+HEADER = struct.Struct("=8sQQQ")
+COLUMNS = (("fsize", "q"), ("mtime_ns", "q"), ("dev", "Q"), ("inode", "Q"), ("mode", "I"))  # 8-byte types first
+
+
+def encode_path(path: str) -> bytes:
+    return path.encode("utf-8", "surrogateescape")
+
+
+def export_index(connection: Union[str, sqlite3.Connection],
+                 index_path: str,
+                 table: str = "files",
+                 root: Optional[str] = None) -> int:
+    """
+    Write the inventory (or the part below root) to a path index file
+    :param connection: database of the scanner, path or open connection
+    :param index_path: file to write, replaced atomically
+    :param table: inventory table of the scanner
+    :param root: only export the paths below this directory
+    :return: number of paths exported
+    """
+    conn = sqlite3.connect(connection) if isinstance(connection, str) else connection
+    query = f"SELECT path, fsize, mtime_ns, dev, inode, mode FROM {table}"
+    params = ()
+    if root is not None:
+        query += " WHERE path >= ? AND path < ?"
+        params = path_range(normalize_path(root))
+    rows = conn.execute(query + " ORDER BY path", params)
+    offsets = array("Q", [0])
+    columns = [array(typecode) for _, typecode in COLUMNS]
+    blob = bytearray()
+    for path, *facts in rows:
+        blob += encode_path(path)
+        offsets.append(len(blob))
+        for column, value in zip(columns, facts):
+            column.append(value or 0)
+    generation = conn.execute(f"SELECT COALESCE(MAX(generation), 0) FROM {table}").fetchone()[0]
+    if conn is not connection:
+        conn.close()
+    count = len(offsets) - 1
+    # absolute file positions spare an addition in every step of a binary search
+    blob_start = HEADER.size + (count + 1) * offsets.itemsize + sum(count * column.itemsize for column in columns)
+    offsets = array("Q", (offset + blob_start for offset in offsets))
+    tmp_path = f"{index_path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, count, len(blob), generation))
+            offsets.tofile(f)
+            for column in columns:
+                column.tofile(f)
+            f.write(blob)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+class PathIndex:
+    """
+    Read-only view on an exported path index
+
+    :ivar count: number of paths
+    :ivar generation: last scan generation included in the export
+    """
+
+    def __init__(self, index_path: str) -> None:
+        with open(index_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self.count, _, self.generation = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            view.release()
+            self._mmap.close()
+            raise ValueError(f"{index_path} is not a path index for this platform")
+        position = HEADER.size
+        self._offsets = view[position:position + (self.count + 1) * 8].cast("Q")
+        position += (self.count + 1) * 8
+        self._columns = []
+        for _, typecode in COLUMNS:
+            size = self.count * array(typecode).itemsize
+            self._columns.append(view[position:position + size].cast(typecode))
+            position += size
+        self._view = view
+
+    def __enter__(self) -> "PathIndex":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for view in [self._offsets, *self._columns, self._view]:
+            view.release()
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _key(self, i: int) -> bytes:
+        return self._mmap[self._offsets[i]:self._offsets[i + 1]]
+
+    def _bisect(self, key: bytes) -> int:
+        """
+        Position of the first path >= key
+        """
+        # the hot loop of every lookup: slicing the mmap gives bytes without extra calls
+        data, offsets = self._mmap, self._offsets
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def path(self, i: int) -> str:
+        return self._key(i).decode("utf-8", "surrogateescape")
+
+    def fact(self, i: int) -> Fact:
+        fsize, mtime_ns, dev, inode, mode = self._columns
+        return Fact(fsize[i], mtime_ns[i], mode[i], dev[i], inode[i])
+
+    def find(self, path: str) -> int:
+        """
+        Position of a path, -1 if it is not in the index. Like the inventory, relative paths
+        are taken from the current directory.
+        """
+        key = encode_path(normalize_path(path))
+        i = self._bisect(key)
+        return i if i < self.count and self._key(i) == key else -1
+
+    def lookup(self, path: str) -> Optional[Fact]:
+        """
+        Facts of a path, None if it is not in the index
+        """
+        i = self.find(path)
+        return self.fact(i) if i >= 0 else None
+
+    def __contains__(self, path: str) -> bool:
+        return self.find(path) >= 0
+
+    def prefix_range(self, directory: str) -> Tuple[int, int]:
+        """
+        Positions [lo, hi) of all paths below a directory, at any depth
+        """
+        lo, hi = path_range(normalize_path(directory))
+        return self._bisect(encode_path(lo)), self._bisect(encode_path(hi))
+
+    def below(self, directory: str) -> Iterator[Tuple[str, Fact]]:
+        """
+        Yield (path, facts) of all files below a directory, in path order
+        """
+        lo, hi = self.prefix_range(directory)
+        for i in range(lo, hi):
+            yield self.path(i), self.fact(i)
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
@@ -1,108 +1,1255 @@
 """
 FILE_INFORMATION=Fluvius;Arvid Claassen;Some python code
 """
+import hashlib
 import os
+import queue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 import sqlite3
 import stat
-from dataclasses import dataclass
+import threading
+import time
+from array import array
+from collections import Counter
 from datetime import datetime
-from pathlib import Path
-from typing import Dict, Tuple, Union
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-from filesystem import file_hash
-from sqlite import create_table, datetime_to_sqlite
+from claar.constants import KB, MB, NANOSECONDS_PER_SECOND
+from claar.filesystem import file_hash
+from claar.logger_tools import SCRIPT_LOGGER
+from claar.os_tools import LoadThrottle
+from claar.sqlite import create_table, datetime_to_sqlite
+from claar.time_tools import RateLimiter
 
+if TYPE_CHECKING:
+    from claar.inotify import Inotify
+
+SCAN_WORKERS = 8  # number of threads exploring directories
+SCAN_BATCH_SIZE = 1000  # number of files handed to the database writer at once
+SCAN_QUEUE_SIZE = 64  # max number of batches waiting for the writer
+PROGRESS_INTERVAL = 5  # seconds between progress reports
+
+WATCH_WINDOW = 2.0  # seconds during which file system events are coalesced
+
+HEADER_MARKER = b"FILE_INFORMATION="  # see the top of this file
+HEADER_BYTES = 4 * KB  # only the start of a file is searched for the marker
+HEADER_WORKERS = 8
+
+HASH_ALGORITHMS = ("sha256", "blake2b")
+HASH_WORKERS = 4
+HASH_CHUNK = MB
 
 TABLE_DEF = """
     path TEXT PRIMARY KEY,
-    mtime TEXT NOT NULL,
     fsize INTEGER NOT NULL,
-    perms TEXT NOT NULL,
-    info TEXT NOT NULL
+    mtime_ns INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    digest TEXT
+"""
+
+HASHES_DEF = """
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    fsize INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, inode, algorithm)
+"""
+
+GENERATIONS_DEF = """
+    generation INTEGER PRIMARY KEY AUTOINCREMENT,
+    root TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    added INTEGER,
+    removed INTEGER,
+    modified INTEGER
+"""
+
+DIRS_DEF = """
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL,
+    entries INTEGER NOT NULL,
+    files_digest TEXT NOT NULL,
+    tree_digest TEXT,
+    generation INTEGER NOT NULL
+"""
+
+DIRS_SCAN_DEF = """
+    path TEXT PRIMARY KEY,
+    prefix TEXT UNIQUE,
+    parent TEXT,
+    mtime_ns INTEGER,
+    entries INTEGER,
+    files_digest TEXT,
+    pruned INTEGER NOT NULL
+"""
+
+# values of the pruned column of the directory staging table
+DIR_LISTED = 0
+DIR_PRUNED = 1  # unchanged, its files were not listed but its known subdirectories were walked
+DIR_FAILED = 2  # could not be listed, nothing below it was walked
+
+CHECKPOINTS_DEF = """
+    generation INTEGER PRIMARY KEY,
+    checkpointed TEXT NOT NULL,
+    files INTEGER NOT NULL
+"""
+
+FRONTIER_DEF = """
+    generation INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (generation, path)
+"""
+
+DIRSIZES_DEF = """
+    path TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    generation INTEGER NOT NULL
+"""
+
+DIRSIZES_HISTORY_DEF = """
+    generation INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    PRIMARY KEY (generation, path)
+"""
+
+CHANGES_DEF = """
+    generation INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    change TEXT NOT NULL,
+    old_mtime_ns INTEGER,
+    new_mtime_ns INTEGER,
+    old_fsize INTEGER,
+    new_fsize INTEGER,
+    old_mode INTEGER,
+    new_mode INTEGER,
+    PRIMARY KEY (generation, path)
 """
 
 
 def normalize_path(p: str) -> str:
     return os.path.abspath(os.path.normpath(p))
 
-@dataclass
-class Fact:
-    mtime: str
+def mtime_str(mtime_ns: Optional[int]) -> Optional[str]:
+    """
+    mtime in nanoseconds as a sqlite timestamp string, for output only
+    """
+    if mtime_ns is None:
+        return None
+    return datetime_to_sqlite(datetime.fromtimestamp(mtime_ns / NANOSECONDS_PER_SECOND))
+
+
+def perms_str(mode: Optional[int]) -> Optional[str]:
+    """
+    Permission bits of a st_mode as an octal string, e.g. '0644' (Windows gives limited info)
+    """
+    if mode is None:
+        return None
+    return f"{stat.S_IMODE(mode):04o}"
+
+
+class Fact(NamedTuple):
+    """
+    Facts of one file, kept numeric; mtime and perms are only formatted when asked for.
+    A tuple takes a fraction of the memory of a regular object.
+    """
     fsize: int
-    perms: str
-    info: str
+    mtime_ns: int
+    mode: int
+    dev: int = 0
+    inode: int = 0
+    info: str = ""
+
+    @property
+    def mtime(self) -> str:
+        return mtime_str(self.mtime_ns)
+
+    @property
+    def perms(self) -> str:
+        return perms_str(self.mode)
+
+
+class FactBatch:
+    """
+    Column-oriented batch of file facts: the numbers are kept in typed arrays
+    (8 bytes per value) and no object is created per file until one is asked for.
+    """
+    __slots__ = ("paths", "fsize", "mtime_ns", "mode", "dev", "inode", "info")
+
+    def __init__(self) -> None:
+        self.paths: List[str] = []
+        self.fsize = array("q")
+        self.mtime_ns = array("q")
+        self.mode = array("L")
+        self.dev = array("Q")
+        self.inode = array("Q")
+        self.info: Dict[int, str] = {}  # sparse, most files have no info
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __iter__(self) -> Iterator[Tuple[str, Fact]]:
+        for i, path in enumerate(self.paths):
+            yield path, self.fact(i)
+
+    def fact(self, i: int) -> Fact:
+        return Fact(self.fsize[i], self.mtime_ns[i], self.mode[i], self.dev[i], self.inode[i], self.info.get(i, ""))
+
+    def append(self, path: str, fact: Fact) -> None:
+        if fact.info:
+            self.info[len(self.paths)] = fact.info
+        self.paths.append(path)
+        self.fsize.append(fact.fsize)
+        self.mtime_ns.append(fact.mtime_ns)
+        self.mode.append(fact.mode)
+        self.dev.append(fact.dev)
+        self.inode.append(fact.inode)
+
+    def append_stat(self, path: str, st: os.stat_result) -> None:
+        self.paths.append(path)
+        self.fsize.append(st.st_size)
+        self.mtime_ns.append(st.st_mtime_ns)
+        self.mode.append(st.st_mode)
+        self.dev.append(st.st_dev)
+        self.inode.append(st.st_ino)
+
+    def rows(self) -> Iterator[tuple]:
+        """
+        (path, fsize, mtime_ns, mode, dev, inode, info) per file, ready for executemany
+        """
+        info = self.info
+        for i, row in enumerate(zip(self.paths, self.fsize, self.mtime_ns, self.mode, self.dev, self.inode)):
+            yield row + (info.get(i, ""),)
+
 
 def get_file_facts(path: str) -> Fact:
     """
-    Bepaal (sha256, mtime_sqlite, perms_octal) voor het bestand.
-    - sha256: hex-string van de inhoud
-    - mtime_sqlite: datum/tijd in sqlite-formaat
-    - perms_octal: permissies als octale string, bv. '0644' (Windows geeft mogelijk beperkte info)
+    Bepaal de feiten (grootte, mtime, mode, device, inode) van het bestand.
     """
-    st = os.stat(path)
-    mtime = datetime.fromtimestamp(st.st_mtime)
-    fsize = str(st.st_size)
-    mtime_sqlite = datetime_to_sqlite(mtime)
-    perms_octal = f"{stat.S_IMODE(st.st_mode):04o}"
-    return Fact(mtime=mtime_sqlite, fsize=fsize, perms=perms_octal, info="")
+    return fact_from_stat(os.stat(path))
 
 
+def fact_from_stat(st: os.stat_result) -> Fact:
+    """
+    Build the facts of a file from a stat result, e.g. the cached one of a DirEntry
+    """
+    return Fact(st.st_size, st.st_mtime_ns, st.st_mode, st.st_dev, st.st_ino)
 
 
+def read_header(path: str, size: int = HEADER_BYTES) -> Optional[str]:
+    """
+    Look for a FILE_INFORMATION= line in the first bytes of a file, with a single read.
+    A NUL byte in that block marks the file as binary, binary files are skipped.
+    :return: the text after the marker up to the end of the line, None if there is none
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(size)
+    except OSError:
+        return None
+    if b"\0" in data:
+        return None
+    start = data.find(HEADER_MARKER)
+    if start < 0:
+        return None
+    start += len(HEADER_MARKER)
+    end = data.find(b"\n", start)
+    return data[start:end if end >= 0 else len(data)].decode("utf-8", errors="replace").strip()
 
 
+def hash_task(path: str,
+              algorithm: str,
+              limiter: Optional[RateLimiter] = None,
+              bandwidth: Optional[float] = None) -> Optional[tuple]:
+    """
+    Hash one file for the hash cache. The file is stat-ed first, so the cache key describes
+    the contents that were actually hashed.
+    Module level, so it can run in a process pool; processes get their own limiter via 'bandwidth'.
+    :return: (path, dev, inode, fsize, mtime_ns, digest) or None if the file can not be read
+    """
+    if limiter is None and bandwidth:
+        limiter = RateLimiter(bandwidth)
+    try:
+        st = os.stat(path)
+        digest = file_hash(path, algorithm, HASH_CHUNK, limiter)
+    except OSError:
+        return None
+    return path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest
+
+
+
+class TreeWalker:
+    """
+    Walk a directory tree with a bounded pool of threads.
+
+    Every worker takes a directory from the queue, lists it with os.scandir and puts the
+    subdirectories back on the queue, so slow (network) directories do not hold up the
+    rest of the tree. The stat information comes from the DirEntry, which avoids the extra
+    os.stat of os.walk on platforms that cache it and needs no path normalisation.
+    Files are handed out in batches through batches().
+
+    With 'known_dirs' (path -> mtime_ns of the previous scan) a directory whose mtime did
+    not change is not listed: its files are assumed unchanged and only its known
+    subdirectories ('subdirs') are visited. A file rewritten in place does not touch the
+    mtime of its directory, so this pruning trades that case for speed.
+
+    The walker keeps track of its frontier: the directories that were found but whose files
+    have not all been consumed yet. Storing that list is enough to continue an interrupted
+    walk later on, by passing it as 'roots'.
+
+    :ivar files: number of files found so far
+    :ivar errors: number of entries or directories that could not be read
+    :ivar dir_records: (path, parent, mtime_ns, entries, files_digest) of every listed directory
+    :ivar pruned: directories that were skipped because they did not change
+    :ivar failed: directories that could not be listed (e.g. no permission)
+    :ivar pending: the frontier, as a counter of directory paths
+    :ivar active_workers: number of workers allowed to list directories, see set_workers
+    """
+
+    def __init__(self,
+                 root: str,
+                 workers: int = SCAN_WORKERS,
+                 batch_size: int = SCAN_BATCH_SIZE,
+                 known_dirs: Optional[Dict[str, int]] = None,
+                 subdirs: Optional[Dict[str, List[str]]] = None,
+                 roots: Optional[List[str]] = None) -> None:
+        self.root = normalize_path(root)
+        self.roots = [self.root] if roots is None else roots
+        self.pending = Counter()
+        self.workers = max(1, workers)
+        self.active_workers = self.workers
+        self.batch_size = batch_size
+        self.known_dirs = known_dirs or {}
+        self.subdirs = subdirs or {}
+        self.files = 0
+        self.errors = 0
+        self.dir_records = []
+        self.pruned = []
+        self.failed = []
+        self.start = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._gate = threading.Condition()
+        self._dirs = queue.Queue()
+        self._out = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of directories waiting to be listed
+        """
+        return self._dirs.qsize()
+
+    @property
+    def files_per_second(self) -> float:
+        """
+        Average throughput since the start of the walk
+        """
+        if self.start is None:
+            return 0.0
+        return self.files / max(time.monotonic() - self.start, 1e-9)
+
+    @property
+    def frontier(self) -> List[str]:
+        """
+        Directories that still have to be (completely) processed
+        """
+        return [path for path, count in self.pending.items() if count > 0]
+
+    def _scan_dir(self, path: str) -> None:
+        batch = FactBatch()
+        summary = []
+        found = []
+        record = None
+        state = DIR_FAILED
+        entries = 0
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if self.known_dirs.get(path) == mtime_ns:
+                found = self.subdirs.get(path, [])
+                for subdir in found:
+                    self._dirs.put(subdir)
+                self._emit(FactBatch(), path, found, state=DIR_PRUNED)
+                return
+            with os.scandir(path) as it:
+                for entry in it:
+                    entries += 1
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            found.append(entry.path)
+                            self._dirs.put(entry.path)
+                        elif not entry.is_dir():  # symlinks to directories are not followed, like os.walk
+                            st = self._stat(entry)
+                            summary.append((entry.name, st.st_size, st.st_mtime_ns, st.st_mode))
+                            batch.append_stat(entry.path, st)
+                            if len(batch) >= self.batch_size:
+                                self._emit(batch)
+                                batch = FactBatch()
+                    except OSError:
+                        with self._lock:
+                            self.errors += 1
+            parent = None if path == self.root else os.path.dirname(path)
+            record = (path, parent, mtime_ns, entries, files_digest(summary))
+            state = DIR_LISTED
+        except (FileNotFoundError, NotADirectoryError):
+            state = DIR_LISTED  # vanished since its parent was listed, so its files are gone as well
+        except OSError:
+            with self._lock:
+                self.errors += 1
+        self._emit(batch, path, found, record, state)
+
+    @staticmethod
+    def _stat(entry: os.DirEntry) -> os.stat_result:
+        try:
+            return entry.stat()
+        except OSError:  # dangling symlink
+            return entry.stat(follow_symlinks=False)
+
+    def _emit(self,
+              batch: FactBatch,
+              done: Optional[str] = None,
+              found: List[str] = (),
+              record: Optional[tuple] = None,
+              state: int = DIR_LISTED) -> None:
+        """
+        Hand a batch to the consumer. The last batch of a directory carries the directory itself,
+        the subdirectories found in it, its record (None if it was pruned or unreadable) and
+        its state (DIR_LISTED, DIR_PRUNED or DIR_FAILED).
+        """
+        with self._lock:
+            self.files += len(batch)
+        self._out.put((batch, done, found, record, state))
+
+    def set_workers(self, count: int) -> None:
+        """
+        Change the number of workers that list directories, between 1 and the pool size.
+        Workers above the count park until they are allowed again.
+        """
+        with self._gate:
+            self.active_workers = max(1, min(self.workers, count))
+            self._gate.notify_all()
+
+    def _worker(self, index: int) -> None:
+        while True:
+            with self._gate:
+                while index >= self.active_workers:
+                    self._gate.wait()
+            path = self._dirs.get()
+            if path is None:
+                break
+            try:
+                if not self._stop.is_set():
+                    self._scan_dir(path)
+            finally:
+                self._dirs.task_done()
+
+    def _coordinator(self, threads: List[threading.Thread]) -> None:
+        self._dirs.join()
+        self.set_workers(self.workers)  # parked workers have to see their end marker
+        for _ in threads:
+            self._dirs.put(None)
+        for thread in threads:
+            thread.join()
+        self._out.put(None)
+
+    def batches(self) -> Iterator[FactBatch]:
+        """
+        Walk the tree and yield batches of file facts as soon as they are available.
+        The consumer runs in the calling thread, so it can safely own the database connection.
+        """
+        self.start = time.monotonic()
+        for root in self.roots:
+            self.pending[root] += 1
+            self._dirs.put(root)
+        threads = [threading.Thread(target=self._worker, args=(i,), daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self._coordinator, args=(threads,), daemon=True).start()
+        while (item := self._out.get()) is not None:
+            batch, done, found, record, state = item
+            for subdir in found:
+                self.pending[subdir] += 1
+            if batch:
+                yield batch
+            if done is not None:
+                # only now all files of the directory have been consumed
+                self.pending[done] -= 1
+                if self.pending[done] == 0:
+                    del self.pending[done]
+                if record is not None:
+                    self.dir_records.append(record)
+                elif state == DIR_PRUNED:
+                    self.pruned.append(done)
+                elif state == DIR_FAILED:
+                    self.failed.append(done)
+
+    def stop(self) -> None:
+        """
+        Stop a running walk: queued directories are skipped and stay in the frontier.
+        Directories that are being listed are finished, so keep consuming batches() until it
+        ends; every stop therefore completes at least the directories in progress.
+        """
+        self._stop.set()
+        self.set_workers(self.workers)
+
+    def take_dirs(self) -> Tuple[List[tuple], List[str], List[str]]:
+        """
+        Hand over the directory records, pruned and failed directories collected so far
+        """
+        records, pruned, failed = self.dir_records, self.pruned, self.failed
+        self.dir_records, self.pruned, self.failed = [], [], []
+        return records, pruned, failed
+
+
+def path_range(root: str) -> Tuple[str, str]:
+    """
+    Half-open bounds of the paths below a root, so "path >= lo AND path < hi" can use the primary
+    key index. hi itself (root + the character after the separator, e.g. /data0) is not below root.
+    """
+    prefix = root if root.endswith(os.sep) else root + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+def files_digest(summary: List[tuple]) -> str:
+    """
+    Digest of the direct files of a directory, from their (name, size, mtime_ns, mode)
+    """
+    hasher = hashlib.sha256()
+    for item in sorted(summary):
+        hasher.update(repr(item).encode())
+    return hasher.hexdigest()
+
+
+def iter_changes(conn: sqlite3.Connection, table: str, generation: int) -> Iterator[tuple]:
+    """
+    Stream the changes found by one scan generation, ordered by path.
+    :return: tuples (change, path, old_mtime, new_mtime, old_fsize, new_fsize, old_perms, new_perms)
+             where change is 'A' (added), 'R' (removed) or 'M' (modified)
+    """
+    for change, path, old_mtime_ns, new_mtime_ns, old_fsize, new_fsize, old_mode, new_mode in conn.execute(
+            f"""
+            SELECT change, path, old_mtime_ns, new_mtime_ns, old_fsize, new_fsize, old_mode, new_mode
+              FROM {table}_changes
+             WHERE generation = ?
+             ORDER BY path
+            """, (generation,)):
+        yield (change, path, mtime_str(old_mtime_ns), mtime_str(new_mtime_ns), old_fsize, new_fsize,
+               perms_str(old_mode), perms_str(new_mode))
+
+
+def subtree_changed(conn: sqlite3.Connection, table: str, path: str, since_generation: int) -> Optional[bool]:
+    """
+    Did anything below a directory change after a generation? One primary key lookup in the
+    directory tree, thanks to the rolled-up digests.
+    :return: True or False, None if the directory is not in the inventory
+    """
+    row = conn.execute(f"SELECT generation FROM {table}_dirs WHERE path = ?", (normalize_path(path),)).fetchone()
+    if row is None:
+        return None
+    return row[0] > since_generation
+
+
+def top_directories(conn: sqlite3.Connection, table: str, limit: int = 50) -> List[tuple]:
+    """
+    Largest directories, counting everything below them
+    :return: (path, bytes, files) per directory, largest first
+    """
+    return conn.execute(
+        f"SELECT path, bytes, files FROM {table}_dirsizes ORDER BY bytes DESC LIMIT ?", (limit,)).fetchall()
+
+
+def directory_growth(conn: sqlite3.Connection,
+                     table: str,
+                     since_generation: int,
+                     until_generation: Optional[int] = None,
+                     limit: int = 50) -> List[tuple]:
+    """
+    Directories that grew the most between two generations, from the stored per-generation deltas
+    :param since_generation: generation to compare with (its own changes are not included)
+    :param until_generation: last generation to include, None for the latest
+    :return: (path, bytes added, files added) per directory, biggest growth first
+    """
+    return conn.execute(
+        f"""
+        SELECT path, SUM(bytes) AS grown, SUM(files)
+          FROM {table}_dirsizes_history
+         WHERE generation > ? AND generation <= COALESCE(?, generation)
+         GROUP BY path
+         ORDER BY grown DESC
+         LIMIT ?
+        """, (since_generation, until_generation, limit)).fetchall()
+
 
 class FileScanner:
+    """
+    Keep an inventory of the files below root in a SQLite table.
 
-    def __init__(self, root: str, db_path: str, table: str = "files") -> None:
+    Every scan is a generation. The walk is written to a temporary staging table, after
+    which added, removed and modified files are determined with set-based SQL against the
+    inventory. Only those rows are written to the inventory and to the change log
+    {table}_changes; unchanged rows are never rewritten.
+    """
+
+    def __init__(self,
+                 root: str,
+                 db_path: str,
+                 table: str = "files",
+                 workers: int = SCAN_WORKERS,
+                 hash_algorithm: Optional[str] = None,
+                 hash_workers: int = HASH_WORKERS,
+                 hash_bandwidth: Optional[float] = None,
+                 hash_processes: bool = False,
+                 prune: bool = False,
+                 checkpoint_interval: Optional[float] = None,
+                 resume: bool = False,
+                 time_slice: Optional[float] = None,
+                 extract_headers: bool = False,
+                 throttle: bool = False,
+                 progress: Optional[Callable[["TreeWalker"], None]] = None) -> None:
+        """
+        :param hash_algorithm: if set (sha256 or blake2b), hash the contents of new and changed files after the scan
+        :param hash_workers: number of parallel hash workers
+        :param hash_bandwidth: max number of bytes per second read by the hash stage, None for unlimited
+        :param hash_processes: hash in a process pool instead of a thread pool
+        :param prune: skip directories whose mtime did not change since the previous scan
+                      (see TreeWalker; files rewritten in place are then not detected)
+        :param checkpoint_interval: seconds between checkpoints of the walk frontier
+        :param resume: continue the last unfinished scan of this root from its checkpoint
+        :param time_slice: stop the walk after this many seconds, leaving a checkpoint to resume from.
+                           The directories being listed at that moment are finished first, so a
+                           slice can take longer, but every slice makes progress.
+        :param extract_headers: store the FILE_INFORMATION= line of new and changed text files in 'info'
+        :param throttle: adapt the walk workers and the hash workers and bandwidth to the server load,
+                         see claar.os_tools.LoadThrottle; the decisions are kept in walk_throttle and hash_throttle
+        :param progress: called with the walker at every progress report and once at the end of the walk
+        """
+        if hash_algorithm is not None and hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm {hash_algorithm}, use one of {HASH_ALGORITHMS}")
         self.root = normalize_path(root)
         self.db_path = db_path
+        self.workers = workers
+        self.hash_algorithm = hash_algorithm
+        self.hash_workers = hash_workers
+        self.hash_bandwidth = hash_bandwidth
+        self.hash_processes = hash_processes
+        self.prune = prune
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.time_slice = time_slice
+        self.extract_headers = extract_headers
+        self.throttle = throttle
+        self.progress = progress
+        self.walk_throttle: Optional[LoadThrottle] = None
+        self.hash_throttle: Optional[LoadThrottle] = None
+        # a resumable scan keeps its staging tables in the database file i.s.o. in TEMP
+        self.resumable = resume or checkpoint_interval is not None or time_slice is not None
+        self.completed = False
         self.conn = None
-        self.table_new = table+"_NEW"
-        self.table_old = table+"_OLD"
+        self.table = table
+        self.table_scan = f"{table}_SCAN"
+        self.table_changes = f"{table}_changes"
+        self.table_generations = f"{table}_generations"
+        self.table_hashes = f"{table}_hashes"
+        self.table_dirs = f"{table}_dirs"
+        self.table_dirsizes = f"{table}_dirsizes"
+        self.table_dirsizes_history = f"{table}_dirsizes_history"
+        self.table_dirs_scan = f"{table}_dirs_SCAN"
+        self.table_checkpoints = f"{table}_checkpoints"
+        self.table_frontier = f"{table}_frontier"
+        self.table_dirty = f"{table}_DIRTY"
+        self.generation = None
         self.ensure_tables()
 
     def ensure_tables(self) -> None:
         self.conn = sqlite3.connect(self.db_path)
-        ok, err = create_table(self.conn, self.table_old, TABLE_DEF, drop=True, create_if_exists=True)
-        print(f"Table {self.table_old} created: {ok}, error: {err}")
-        ok, err = create_table(self.conn, self.table_new, TABLE_DEF, drop=False, create_if_exists=True)
-        print(f"Table {self.table_new} created: {ok}, error: {err}")
-        cur = self.conn.cursor()
-        cur.execute(f"INSERT INTO {self.table_old} SELECT * FROM {self.table_new}")
-        cur.execute(f"DELETE FROM {self.table_new}")
-        if not ok:
-            raise RuntimeError(f"Kon de tabel niet aanmaken of openen: {err}")
+        definitions = [(self.table, f"{TABLE_DEF}, generation INTEGER NOT NULL"),
+                       (self.table_generations, GENERATIONS_DEF),
+                       (self.table_changes, CHANGES_DEF),
+                       (self.table_hashes, HASHES_DEF),
+                       (self.table_dirs, DIRS_DEF),
+                       (self.table_dirsizes, DIRSIZES_DEF),
+                       (self.table_dirsizes_history, DIRSIZES_HISTORY_DEF),
+                       (self.table_checkpoints, CHECKPOINTS_DEF),
+                       (self.table_frontier, FRONTIER_DEF)]
+        for name, definition in definitions:
+            ok, err = create_table(self.conn, name, definition, drop=False, create_if_exists=True)
+            if not ok:
+                raise RuntimeError(f"Kon de tabel {name} niet aanmaken of openen: {err}")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_generation ON {self.table} (generation)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_dirs}_parent ON {self.table_dirs} (parent)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_dirsizes}_bytes ON {self.table_dirsizes} (bytes)")
+        for name, definition in [(self.table_scan, TABLE_DEF), (self.table_dirs_scan, DIRS_SCAN_DEF)]:
+            self.conn.execute(f"DROP TABLE IF EXISTS temp.{name}")
+            if self.resumable:
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({definition})")
+            else:
+                self.conn.execute(f"CREATE TEMP TABLE {name} ({definition})")
+        self.conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table_dirs_scan}_pruned ON {self.table_dirs_scan} (pruned)")
+        self.conn.execute(f"DROP TABLE IF EXISTS temp.{self.table_dirty}")
+        self.conn.execute(f"CREATE TEMP TABLE {self.table_dirty} (path TEXT PRIMARY KEY)")
+        self.conn.commit()
+
+    def previous_generation(self) -> Optional[int]:
+        """
+        Last finished generation of this root, None if the root was never scanned
+        """
+        row = self.conn.execute(
+            f"SELECT MAX(generation) FROM {self.table_generations} WHERE root = ? AND finished IS NOT NULL",
+            (self.root,)).fetchone()
+        return row[0]
+
+    def start_generation(self) -> List[str]:
+        """
+        Start a new generation, or pick up the unfinished one when resuming.
+        :return: the directories the walk has to start from
+        """
+        if self.resume:
+            row = self.conn.execute(
+                f"""SELECT g.generation, c.generation FROM {self.table_generations} g
+                      LEFT JOIN {self.table_checkpoints} c ON c.generation = g.generation
+                     WHERE g.root = ? AND g.finished IS NULL
+                     ORDER BY g.generation DESC LIMIT 1""", (self.root,)).fetchone()
+            if row is not None and row[0] > (self.previous_generation() or 0):
+                self.generation = row[0]
+                if row[1] is not None:
+                    frontier = [path for path, in self.conn.execute(
+                        f"SELECT path FROM {self.table_frontier} WHERE generation = ?", (self.generation,))]
+                    print(f"Resuming generation {self.generation}, {len(frontier)} directories to go.")
+                    return frontier
+                print(f"Generation {self.generation} has no checkpoint, restarting it.")
+                self.clear_staging()
+                return [self.root]
+        self.clear_staging()
+        self.new_generation()
+        return [self.root]
+
+    def new_generation(self) -> int:
+        cur = self.conn.execute(
+            f"INSERT INTO {self.table_generations} (root, started) VALUES (?, ?)",
+            (self.root, datetime_to_sqlite(datetime.now())))
+        self.generation = cur.lastrowid
+        self.conn.commit()
+        return self.generation
+
+    def clear_staging(self) -> None:
+        self.conn.execute(f"DELETE FROM {self.table_scan}")
+        self.conn.execute(f"DELETE FROM {self.table_dirs_scan}")
+        self.conn.commit()
+
+    def store_walked_dirs(self, walker: TreeWalker) -> None:
+        """
+        Move the directories completed by the walker into the staging table
+        """
+        records, pruned, failed = walker.take_dirs()
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table_dirs_scan} VALUES (?, ?, NULL, NULL, NULL, NULL, ?)",
+            [(path, path_range(path)[0], DIR_PRUNED) for path in pruned]
+            + [(path, path_range(path)[0], DIR_FAILED) for path in failed])
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table_dirs_scan} VALUES (?, ?, ?, ?, ?, ?, {DIR_LISTED})",
+            [(record[0], path_range(record[0])[0]) + record[1:] for record in records])
+
+    def checkpoint(self, walker: TreeWalker) -> None:
+        """
+        Persist the frontier of the walk. Every file batch is already committed, so the staging
+        tables together with the frontier describe exactly what is left to do.
+        """
+        self.store_walked_dirs(walker)
+        self.conn.execute(f"DELETE FROM {self.table_frontier} WHERE generation = ?", (self.generation,))
+        self.conn.executemany(f"INSERT INTO {self.table_frontier} (generation, path) VALUES (?, ?)",
+                              [(self.generation, path) for path in walker.frontier])
+        self.conn.execute(f"INSERT OR REPLACE INTO {self.table_checkpoints} VALUES (?, ?, ?)",
+                          (self.generation, datetime_to_sqlite(datetime.now()), walker.files))
+        self.conn.commit()
 
-    def scan(self):
+    def scan(self) -> Optional[int]:
         """
-        Doorloop root, filter tekstbestanden met een 'FILE_information'-regel, vergelijk met SQLite.
+        Doorloop root, vergelijk met de vorige generatie in SQLite en bewaar enkel de wijzigingen.
         Print een rapport en geeft het aantal afwijkingen terug.
+        Geeft None terug als de scan gepauzeerd werd (time_slice) en later hervat moet worden.
         """
-        processed = 0
+        start = last_report = last_checkpoint = time.monotonic()
+        walker = None
         try:
+            previous = self.previous_generation()
+            known_dirs, subdirs = self.load_dirs() if self.prune and previous is not None else (None, None)
+            roots = self.start_generation()
+            walker = TreeWalker(self.root, self.workers, known_dirs=known_dirs, subdirs=subdirs, roots=roots)
+            if self.throttle:
+                self.walk_throttle = LoadThrottle(self.workers)
+            paused = False
+            for batch in walker.batches():
+                self.insert_records(batch)
+                if self.walk_throttle is not None:
+                    walker.set_workers(self.walk_throttle.update())
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    print(f"Processed {walker.files} files ({walker.files_per_second:.0f} files/s), "
+                          f"{walker.queue_depth} directories queued..."
+                          + (f" [{self.walk_throttle}]" if self.walk_throttle is not None else ""))
+                    if self.progress is not None:
+                        self.progress(walker)
+                if self.checkpoint_interval is not None and now - last_checkpoint >= self.checkpoint_interval:
+                    last_checkpoint = now
+                    self.checkpoint(walker)
+                if self.time_slice is not None and not paused and now - start >= self.time_slice:
+                    # the batches of the directories in progress still follow
+                    walker.stop()
+                    paused = True
+            if paused and walker.frontier:
+                self.checkpoint(walker)
+                print(f"Scan paused after {walker.files} files, {len(walker.frontier)} directories to go.")
+                return None
+            print(f"Processed {walker.files} files ({walker.files_per_second:.0f} files/s), {walker.errors} errors, "
+                  f"{len(walker.pruned)} unchanged directories skipped"
+                  + (f", {len(walker.failed)} unreadable directories kept as they were." if walker.failed else "."))
+            if self.progress is not None:
+                self.progress(walker)
+            self.store_walked_dirs(walker)
+            counts = self.apply_changes()
+            self.update_dirsizes()
+            self.update_dirs()
+            self.conn.execute(f"DELETE FROM {self.table_frontier} WHERE generation = ?", (self.generation,))
+            self.conn.execute(f"DELETE FROM {self.table_checkpoints} WHERE generation = ?", (self.generation,))
+            self.conn.commit()
+            self.completed = True
+            walker = None
+            print(f"Generation {self.generation}: {counts['A']} added, {counts['R']} removed, {counts['M']} modified.")
+            if self.extract_headers:
+                self.update_headers()
+            if self.hash_algorithm is not None:
+                self.update_hashes()
+            if previous is not None:
+                for change in iter_changes(self.conn, self.table, self.generation):
+                    print(" ".join(f"{value}" for value in change))
+        except BaseException:
+            if self.resumable and walker is not None:
+                # keep what has been done so far, a next run with resume=True continues from here
+                self.checkpoint(walker)
+            raise
+        finally:
+            self.conn.close()
+        return counts["R"] + counts["M"] + (counts["A"] if previous is not None else 0)
 
-            for dirpath, _, filenames in os.walk(self.root):
-                for name in filenames:
-                    path = normalize_path(os.path.join(dirpath, name))
-                    processed += 1
-                    current = get_file_facts(path)
-                    if processed % 1000 == 0:
-                        print(f"Processed {processed} files...")
-                    self.insert_record(path, current)
+    def apply_changes(self, dirty: bool = False) -> Dict[str, int]:
+        """
+        Compare the staging table with the inventory, log the differences in the change table
+        and apply them to the inventory, all in one transaction.
+        :param dirty: only the paths in the dirty table were checked (watch mode), so only
+                      those can have been removed; otherwise the whole root was walked, except
+                      below pruned directories (their direct files) and unreadable ones (everything)
+        :return: number of changes per change type
+        """
+        lo, hi = path_range(self.root)
+        params = {"gen": self.generation, "lo": lo, "hi": hi, "sep": os.sep}
+        if dirty:
+            scope = f"i.path IN (SELECT path FROM {self.table_dirty})"
+        else:
+            scope = f"""i.path >= :lo AND i.path < :hi
+               AND NOT EXISTS (SELECT 1 FROM {self.table_dirs_scan} d
+                                WHERE d.pruned = {DIR_PRUNED}
+                                  AND d.prefix = rtrim(i.path, replace(i.path, :sep, '')))
+               AND NOT EXISTS (SELECT 1 FROM {self.table_dirs_scan} d
+                                WHERE d.pruned = {DIR_FAILED}
+                                  AND substr(i.path, 1, length(d.prefix)) = d.prefix)"""
+        cur = self.conn.cursor()
+        cur.execute(f"""
+            INSERT INTO {self.table_changes}
+            SELECT :gen, s.path, 'A', NULL, s.mtime_ns, NULL, s.fsize, NULL, s.mode
+              FROM {self.table_scan} s
+             WHERE NOT EXISTS (SELECT 1 FROM {self.table} i WHERE i.path = s.path)
+            """, params)
+        cur.execute(f"""
+            INSERT INTO {self.table_changes}
+            SELECT :gen, i.path, 'R', i.mtime_ns, NULL, i.fsize, NULL, i.mode, NULL
+              FROM {self.table} i
+             WHERE NOT EXISTS (SELECT 1 FROM {self.table_scan} s WHERE s.path = i.path)
+               AND {scope}
+            """, params)
+        cur.execute(f"""
+            INSERT INTO {self.table_changes}
+            SELECT :gen, s.path, 'M', i.mtime_ns, s.mtime_ns, i.fsize, s.fsize, i.mode, s.mode
+              FROM {self.table_scan} s
+              JOIN {self.table} i ON i.path = s.path
+             WHERE i.mtime_ns <> s.mtime_ns OR i.fsize <> s.fsize OR i.mode <> s.mode
+            """, params)
+        cur.execute(f"""
+            DELETE FROM {self.table}
+             WHERE path IN (SELECT path FROM {self.table_changes} WHERE generation = :gen AND change = 'R')
+            """, params)
+        cur.execute(f"""
+            INSERT OR REPLACE INTO {self.table} (path, fsize, mtime_ns, mode, dev, inode, info, generation)
+            SELECT s.path, s.fsize, s.mtime_ns, s.mode, s.dev, s.inode, s.info, :gen
+              FROM {self.table_changes} c
+              JOIN {self.table_scan} s ON s.path = c.path
+             WHERE c.generation = :gen AND c.change IN ('A', 'M')
+            """, params)
+        counts = {change: count for change, count in cur.execute(
+            f"SELECT change, COUNT(*) FROM {self.table_changes} WHERE generation = :gen GROUP BY change", params)}
+        counts = {change: counts.get(change, 0) for change in "ARM"}
+        cur.execute(f"""
+            UPDATE {self.table_generations}
+               SET finished = :now, added = :A, removed = :R, modified = :M
+             WHERE generation = :gen
+            """, {**params, **counts, "now": datetime_to_sqlite(datetime.now())})
+        cur.execute(f"DELETE FROM {self.table_scan}")
+        cur.execute(f"DELETE FROM {self.table_dirty}")
+        self.conn.commit()
+        return counts
+
+    def watch(self, window: float = WATCH_WINDOW, duration: Optional[float] = None) -> None:
+        """
+        Keep the inventory current with inotify (Linux) instead of periodic scans.
+        Run scan() first; the watcher only applies what changes afterwards. Events are
+        coalesced during 'window' seconds and applied as one generation. A new directory is
+        walked as a whole, and when the kernel event queue overflows the whole root is watched and rescanned again.
+        The directory tree of the pruning scan is not maintained here, a next scan() refreshes it.
+        :param window: seconds to collect events before they are written
+        :param duration: stop after this many seconds, None to run until interrupted
+        """
+        from claar.inotify import Inotify  # Linux only, the rest of the scanner also runs elsewhere
 
+        self.ensure_tables()
+        watches: Dict[int, str] = {}
+        stop_at = None if duration is None else time.monotonic() + duration
+        try:
+            with Inotify() as notifier:
+                self._watch_tree(notifier, watches, self.root)
+                print(f"Watching {len(watches)} directories below {self.root}")
+                while stop_at is None or time.monotonic() < stop_at:
+                    events = notifier.read_events(1.0)
+                    if not events:
+                        continue
+                    deadline = time.monotonic() + window
+                    while (remaining := deadline - time.monotonic()) > 0:
+                        events += notifier.read_events(remaining)
+                    self._apply_events(notifier, watches, events)
         finally:
             self.conn.close()
-        print(f"Processed {processed} files.")
+
+    def _watch_tree(self, notifier: "Inotify", watches: Dict[int, str], top: str) -> None:
+        from claar.inotify import IN_CHANGES
+
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            try:
+                watches[notifier.add_watch(path, IN_CHANGES)] = path
+                with os.scandir(path) as it:
+                    stack += [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+            except FileNotFoundError:
+                pass  # vanished in the meantime
+            except OSError as e:
+                # e.g. ENOSPC when fs.inotify.max_user_watches is reached: changes below it go unnoticed
+                SCRIPT_LOGGER.warning(f"Cannot watch {path}: {e}")
+
+    def _unwatch_tree(self, notifier: "Inotify", watches: Dict[int, str], top: str) -> None:
+        prefix = path_range(top)[0]
+        for wd, path in list(watches.items()):
+            if path == top or path.startswith(prefix):
+                notifier.rm_watch(wd)
+                del watches[wd]
+
+    def _apply_events(self, notifier: "Inotify", watches: Dict[int, str], events: list) -> None:
+        """
+        Turn a window of events into one generation: re-stat the touched files, walk new directories
+        """
+        from claar.inotify import IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
+
+        files, subtrees = set(), set()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                # events were lost, also those of new directories that still need a watch
+                self._watch_tree(notifier, watches, self.root)
+                subtrees = {self.root}
+                break
+            if event.mask & IN_IGNORED:
+                watches.pop(event.wd, None)
+                continue
+            if event.wd not in watches:
+                continue
+            path = os.path.join(watches[event.wd], event.name) if event.name else watches[event.wd]
+            if event.mask & IN_ISDIR:
+                if event.mask & (IN_MOVED_FROM | IN_DELETE):
+                    self._unwatch_tree(notifier, watches, path)
+                    subtrees.add(path)
+                elif event.mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may have been created before the watch was in place, so walk it
+                    self._watch_tree(notifier, watches, path)
+                    subtrees.add(path)
+            elif event.name:
+                files.add(path)
+        self.new_generation()
+        self.conn.executemany(f"INSERT OR IGNORE INTO {self.table_dirty} VALUES (?)", [(path,) for path in files])
+        records = FactBatch()
+        for path in files:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                st = os.lstat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                records.append_stat(path, st)
+        self.insert_records(records)
+        for top in subtrees:
+            lo, hi = path_range(top)
+            self.conn.execute(f"""
+                INSERT OR IGNORE INTO {self.table_dirty}
+                SELECT path FROM {self.table} WHERE path = ? OR (path >= ? AND path < ?)
+                """, (top, lo, hi))
+            if os.path.isdir(top):
+                for batch in TreeWalker(top, self.workers).batches():
+                    self.insert_records(batch)
+        counts = self.apply_changes(dirty=True)
+        self.update_dirsizes()
+        print(f"Generation {self.generation}: {counts['A']} added, {counts['R']} removed, {counts['M']} modified "
+              f"({len(events)} events).")
+        if self.extract_headers:
+            self.update_headers()
+        if self.hash_algorithm is not None:
+            self.update_hashes()
+
+    def update_dirsizes(self) -> int:
+        """
+        Keep the recursive byte and file counts per directory up to date from the file
+        changes of the current generation: every change is added to all directories above
+        the file, up to root. The deltas are kept per generation for growth reports.
+        When the root has no aggregate yet, it is built once from the inventory.
+        :return: number of directories updated
+        """
+        deltas: Dict[str, list] = {}
+        lo, hi = path_range(self.root)
+        rebuild = self.conn.execute(
+            f"SELECT 1 FROM {self.table_dirsizes} WHERE path = ?", (self.root,)).fetchone() is None
+        if rebuild:
+            self.conn.execute(f"DELETE FROM {self.table_dirsizes} WHERE path = ? OR (path >= ? AND path < ?)",
+                              (self.root, lo, hi))
+            changes = ((path, fsize, 1) for path, fsize in self.conn.execute(
+                f"SELECT path, fsize FROM {self.table} WHERE path >= ? AND path < ?", (lo, hi)))
+        else:
+            changes = ((path, (new or 0) - (old or 0), {"A": 1, "R": -1}.get(change, 0))
+                       for change, path, old, new in self.conn.execute(
+                           f"""SELECT change, path, old_fsize, new_fsize FROM {self.table_changes}
+                                WHERE generation = ?""", (self.generation,)))
+        for path, size_delta, files_delta in changes:
+            directory = os.path.dirname(path)
+            while True:
+                delta = deltas.setdefault(directory, [0, 0])
+                delta[0] += size_delta
+                delta[1] += files_delta
+                if directory == self.root or len(directory) <= len(self.root):
+                    break
+                directory = os.path.dirname(directory)
+        rows = [(path, size, files, self.generation) for path, (size, files) in deltas.items() if size or files]
+        self.conn.executemany(f"""
+            INSERT INTO {self.table_dirsizes} (path, bytes, files, generation) VALUES (?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + excluded.files,
+                                             generation = excluded.generation
+            """, rows)
+        self.conn.executemany(f"""
+            INSERT OR REPLACE INTO {self.table_dirsizes_history} (path, bytes, files, generation)
+            VALUES (?, ?, ?, ?)
+            """, rows)
+        self.conn.execute(f"""
+            DELETE FROM {self.table_dirsizes}
+             WHERE files <= 0 AND generation = ? AND path <> ?""", (self.generation, self.root))
+        self.conn.commit()
+        return len(rows)
+
+    def load_dirs(self) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        """
+        Directory mtimes and subdirectories of the previous scan, for pruning
+        """
+        lo, hi = path_range(self.root)
+        known_dirs, subdirs = {}, {}
+        for path, parent, mtime_ns in self.conn.execute(
+                f"SELECT path, parent, mtime_ns FROM {self.table_dirs} WHERE path = ? OR (path >= ? AND path < ?)",
+                (self.root, lo, hi)):
+            known_dirs[path] = mtime_ns
+            subdirs.setdefault(parent, []).append(path)
+        return known_dirs, subdirs
+
+    def update_dirs(self) -> None:
+        """
+        Store the listed directories, drop the ones that disappeared and roll the
+        digests up the tree. Only directories whose tree digest changed get the new generation.
+        """
+        lo, hi = path_range(self.root)
+        self.conn.execute(f"""
+            INSERT INTO {self.table_dirs} (path, parent, mtime_ns, entries, files_digest, generation)
+            SELECT path, parent, mtime_ns, entries, files_digest, {self.generation}
+              FROM {self.table_dirs_scan}
+             WHERE pruned = {DIR_LISTED}
+            ON CONFLICT (path) DO UPDATE SET mtime_ns = excluded.mtime_ns, entries = excluded.entries,
+                                             files_digest = excluded.files_digest
+            """)
+        self.conn.execute(f"""
+            DELETE FROM {self.table_dirs}
+             WHERE (path = :root OR (path >= :lo AND path < :hi))
+               AND NOT EXISTS (SELECT 1 FROM {self.table_dirs_scan} d WHERE d.path = {self.table_dirs}.path)
+               AND NOT EXISTS (SELECT 1 FROM {self.table_dirs_scan} d
+                                WHERE d.pruned = {DIR_FAILED}
+                                  AND substr({self.table_dirs}.path, 1, length(d.prefix)) = d.prefix)
+            """, {"root": self.root, "lo": lo, "hi": hi})
+        info, children = {}, {}
+        for path, parent, digest, tree_digest in self.conn.execute(
+                f"""SELECT path, parent, files_digest, tree_digest FROM {self.table_dirs}
+                     WHERE path = ? OR (path >= ? AND path < ?)""", (self.root, lo, hi)):
+            info[path] = (digest, tree_digest)
+            children.setdefault(parent, []).append(path)
+        rolled = {}
+        for path in sorted(info, key=lambda p: p.count(os.sep), reverse=True):
+            hasher = hashlib.sha256(info[path][0].encode())
+            for child in sorted(children.get(path, ())):
+                hasher.update(rolled[child].encode())
+            rolled[path] = hasher.hexdigest()
+        self.conn.executemany(
+            f"UPDATE {self.table_dirs} SET tree_digest = ?, generation = ? WHERE path = ?",
+            [(digest, self.generation, path) for path, digest in rolled.items() if digest != info[path][1]])
+        self.conn.execute(f"DELETE FROM {self.table_dirs_scan}")
+        self.conn.commit()
+
+    def update_headers(self, all_files: bool = False) -> int:
+        """
+        Read the FILE_INFORMATION= header of the files that were added or modified in the
+        current generation, in parallel, and store it in 'info'. Unchanged files keep the
+        header found before and are not opened.
+        :param all_files: look at every file below root, e.g. the first time headers are extracted
+        :return: number of headers found
+        """
+        lo, hi = path_range(self.root)
+        if all_files or self.generation is None:
+            todo = self.conn.execute(f"SELECT path FROM {self.table} WHERE path >= ? AND path < ?", (lo, hi))
+        else:
+            todo = self.conn.execute(f"SELECT path FROM {self.table} WHERE generation = ?", (self.generation,))
+        paths = [path for path, in todo]
+        with ThreadPoolExecutor(HEADER_WORKERS) as pool:
+            headers = list(pool.map(read_header, paths, chunksize=SCAN_BATCH_SIZE))
+        self.conn.executemany(
+            f"UPDATE {self.table} SET info = ? WHERE path = ? AND info <> ?",
+            [(header or "", path, header or "") for path, header in zip(paths, headers)])
+        self.conn.commit()
+        found = sum(header is not None for header in headers)
+        print(f"Read the header of {len(paths)} files, {found} with {HEADER_MARKER.decode()}.")
+        return found
+
+    def update_hashes(self) -> int:
+        """
+        Hash the files whose (dev, inode, fsize, mtime_ns) is not in the hash cache yet,
+        then copy the digests from the cache to the inventory where they differ.
+        An unchanged tree therefore costs two indexed queries and no file reads.
+        :return: number of files hashed
+        """
+        lo, hi = path_range(self.root)
+        params = {"alg": self.hash_algorithm, "lo": lo, "hi": hi}
+        todo = [path for path, in self.conn.execute(f"""
+            SELECT i.path
+              FROM {self.table} i
+              LEFT JOIN {self.table_hashes} h
+                ON h.dev = i.dev AND h.inode = i.inode AND h.algorithm = :alg
+             WHERE i.path >= :lo AND i.path < :hi
+               AND (h.digest IS NULL OR h.fsize <> i.fsize OR h.mtime_ns <> i.mtime_ns)
+            """, params)]
+        hashed = 0
+        start = time.monotonic()
+        if todo:
+            if self.hash_processes:
+                pool = ProcessPoolExecutor(self.hash_workers)
+                per_worker = self.hash_bandwidth / self.hash_workers if self.hash_bandwidth else None
+                tasks = ((hash_task, path, self.hash_algorithm, None, per_worker) for path in todo)
+            else:
+                pool = ThreadPoolExecutor(self.hash_workers)
+                limiter = RateLimiter(self.hash_bandwidth)
+                if self.throttle:
+                    # a process pool has no shared limiter, only the number of files in flight is adapted there
+                    self.hash_throttle = LoadThrottle(self.hash_workers, self.hash_bandwidth, limiter=limiter)
+                tasks = ((hash_task, path, self.hash_algorithm, limiter) for path in todo)
+            if self.throttle and self.hash_throttle is None:
+                self.hash_throttle = LoadThrottle(self.hash_workers)
+            with pool:
+                batch = []
+                for future in self._hash_results(pool, tasks):
+                    result = future.result()
+                    if result is None:
+                        continue
+                    batch.append(result[1:5] + (self.hash_algorithm, result[5]))
+                    hashed += 1
+                    if len(batch) >= SCAN_BATCH_SIZE:
+                        self._store_hashes(batch)
+                        batch = []
+                self._store_hashes(batch)
+        self.conn.execute(f"""
+            UPDATE {self.table}
+               SET digest = (SELECT h.digest FROM {self.table_hashes} h
+                              WHERE h.dev = {self.table}.dev AND h.inode = {self.table}.inode
+                                AND h.algorithm = :alg AND h.fsize = {self.table}.fsize
+                                AND h.mtime_ns = {self.table}.mtime_ns)
+             WHERE path >= :lo AND path < :hi
+               AND digest IS NOT (SELECT h.digest FROM {self.table_hashes} h
+                                   WHERE h.dev = {self.table}.dev AND h.inode = {self.table}.inode
+                                     AND h.algorithm = :alg AND h.fsize = {self.table}.fsize
+                                     AND h.mtime_ns = {self.table}.mtime_ns)
+            """, params)
+        self.conn.commit()
+        print(f"Hashed {hashed} of {len(todo)} files in {time.monotonic() - start:.1f}s."
+              + (f" [{self.hash_throttle}]" if self.hash_throttle is not None else ""))
+        return hashed
+
+    def _hash_results(self, pool, tasks: Iterator[tuple]) -> Iterator:
+        """
+        Submit the hash tasks and yield their futures as they complete. At most a few tasks per
+        worker are in flight, so the todo list is never held in memory as futures; with throttle
+        only as many as it allows workers.
+        """
+        running = set()
+        for task in tasks:
+            while True:
+                if self.hash_throttle is None:
+                    limit, timeout = self.hash_workers * 4, None
+                else:
+                    limit, timeout = self.hash_throttle.update(), self.hash_throttle.interval
+                if len(running) < limit:
+                    break
+                done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                yield from done
+            running.add(pool.submit(*task))
+        yield from as_completed(running)
+
+    def _store_hashes(self, rows: list) -> None:
+        self.conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO {self.table_hashes} (dev, inode, fsize, mtime_ns, algorithm, digest)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+        self.conn.commit()
 
     def insert_record(self, path: str, fact: Fact) -> None:
-        cur = self.conn.cursor()
-        cur.execute(
+        batch = FactBatch()
+        batch.append(path, fact)
+        self.insert_records(batch)
+
+    def insert_records(self, records: FactBatch) -> None:
+        """
+        Insert a batch of facts in the staging table in one transaction
+        """
+        self.conn.executemany(
             f"""
-            INSERT INTO {self.table_new} (path, mtime, fsize, perms, info)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT OR REPLACE INTO {self.table_scan} (path, fsize, mtime_ns, mode, dev, inode, info)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (path, fact.mtime, fact.fsize, fact.perms, fact.info),
+            records.rows(),
         )
         self.conn.commit()
 
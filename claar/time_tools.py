@@ -3,6 +3,7 @@ Time constants and method
 """
 
 import os
+import threading
 import uuid
 from datetime import datetime, timedelta
 import time
@@ -138,6 +139,48 @@ def labeled_sleep(delay: float,
         print(text)
     time.sleep(delay)
 
+class RateLimiter:
+    """
+    Token bucket that limits a throughput, e.g. bytes per second, shared by several threads.
+
+    A consumer that takes more than is available goes into debt and sleeps until the
+    bucket refills, so the average rate never exceeds 'rate'. The rate can be changed
+    while the limiter is in use; a rate of None means unlimited.
+
+    :ivar rate: allowed amount per second, None for unlimited
+    :ivar burst: max amount that can be consumed without waiting after an idle period
+    :ivar consumed: total amount consumed so far
+    """
+
+    def __init__(self, rate: Optional[float], burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.consumed = 0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        """
+        Take an amount from the bucket, sleeping if the budget is exhausted
+        :param amount: amount to consume, e.g. the number of bytes just read
+        :return: number of seconds slept
+        """
+        with self._lock:
+            self.consumed += amount
+            rate = self.rate
+            if not rate:
+                return 0.0
+            now = time.monotonic()
+            burst = self.burst if self.burst is not None else rate
+            self._tokens = min(burst, self._tokens + (now - self._last) * rate) - amount
+            self._last = now
+            delay = -self._tokens / rate if self._tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
 class Lap:
     """
     Lap, like on a stopwatch
@@ -0,0 +1,229 @@
+"""
+Compact storage of quarter-hour time series in SQLite.
+
+One row is kept per (series, day). The 96 quarter-hour values of that day are packed
+in a little-endian BLOB, next to a bit mask that tells which quarters are filled in.
+Reads decode the BLOBs straight into NumPy arrays with frombuffer.
+
+Days and quarters are UTC, so every day has exactly 96 quarters. Local wall-clock time
+would not fit: on the DST fall-back day 02:00-03:00 occurs twice and both hours would land
+in the same slots. Timezone-aware timestamps are converted to UTC, naive ones are refused
+unless the store is told they are UTC already (naive_utc=True).
+"""
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
+
+from claar.constants import MILLISECONDS_PER_QUARTER_HOUR, MILLISECONDS_PER_SECOND, QUARTERS_PER_DAY
+from claar.time_tools import round_to_previous_quarter
+
+SECONDS_PER_QUARTER_HOUR = MILLISECONDS_PER_QUARTER_HOUR // MILLISECONDS_PER_SECOND
+
+# supported value types, always stored little-endian
+DTYPES = {"float": "<f8", "float32": "<f4", "int": "<i8", "int32": "<i4"}
+DEFAULT_DTYPE = "float"
+
+TABLE_DEF = """
+    series TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    vals BLOB NOT NULL,
+    mask BLOB NOT NULL,
+    PRIMARY KEY (series, day)
+"""
+
+
+def to_utc(timestamp: datetime, naive_utc: bool = False) -> datetime:
+    """
+    Naive UTC equivalent of a timestamp
+    :param timestamp: timezone-aware timestamp, or naive UTC if naive_utc
+    :param naive_utc: accept naive timestamps as UTC instead of refusing them
+    """
+    if timestamp.utcoffset() is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    if not naive_utc:
+        raise ValueError(f"Naive timestamp {timestamp} is ambiguous around DST changes, pass a timezone-aware "
+                         f"timestamp or open the store with naive_utc=True if it is UTC")
+    return timestamp
+
+
+def quarter_index(timestamp: datetime) -> Tuple[int, int]:
+    """
+    Locate the quarter-hour slot of a timestamp.
+    :param timestamp: naive UTC timestamp (see to_utc), rounded down to the previous quarter
+    :return: (day number as proleptic Gregorian ordinal, quarter of the day 0..95)
+    """
+    timestamp = round_to_previous_quarter(timestamp)
+    quarter = (timestamp.hour * 3600 + timestamp.minute * 60) // SECONDS_PER_QUARTER_HOUR
+    return timestamp.toordinal(), quarter
+
+
+def quarter_timestamp(day: int, quarter: int) -> datetime:
+    """
+    Inverse of quarter_index
+    :param day: day number (proleptic Gregorian ordinal)
+    :param quarter: quarter of the day, may exceed 95 to step into the next days
+    :return: start timestamp of the quarter, naive UTC
+    """
+    return datetime.combine(date.fromordinal(day), datetime.min.time()) + \
+        timedelta(seconds=quarter * SECONDS_PER_QUARTER_HOUR)
+
+
+class TimeSeriesStore:
+    """
+    Quarter-hour time series packed per day in a SQLite table.
+
+    Missing quarters are tracked in a bit mask, so integer series do not need a
+    sentinel value. Reads return the values together with a boolean 'present' array.
+
+    :ivar conn: open connection to the database
+    :ivar table: name of the table holding the packed days
+    :ivar dtype: numpy dtype of the stored values
+    :ivar naive_utc: naive timestamps are taken as UTC instead of refused
+    """
+
+    def __init__(self,
+                 connection: Union[str, sqlite3.Connection],
+                 table: str = "timeseries",
+                 value_type: str = DEFAULT_DTYPE,
+                 naive_utc: bool = False) -> None:
+        if value_type not in DTYPES:
+            raise ValueError(f"Unsupported value type {value_type}, use one of {list(DTYPES)}")
+        self.conn = sqlite3.connect(connection) if isinstance(connection, str) else connection
+        self.table = table
+        self.dtype = np.dtype(DTYPES[value_type])
+        self.naive_utc = naive_utc
+        try:
+            # WITHOUT ROWID keeps the rows clustered on (series, day), which makes range reads sequential
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({TABLE_DEF}) WITHOUT ROWID")
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise RuntimeError(f"Kon de tabel {table} niet aanmaken of openen: {e}")
+
+    def close(self) -> None:
+        """
+        Close the underlying connection
+        """
+        self.conn.close()
+
+    def _empty_day(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.zeros(QUARTERS_PER_DAY, dtype=self.dtype), np.zeros(QUARTERS_PER_DAY, dtype=bool)
+
+    def _decode(self, vals: bytes, mask: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        values = np.frombuffer(vals, dtype=self.dtype)
+        if len(values) != QUARTERS_PER_DAY:
+            raise ValueError(f"Corrupt day record in {self.table}: {len(values)} values")
+        present = np.unpackbits(np.frombuffer(mask, dtype=np.uint8), count=QUARTERS_PER_DAY).astype(bool)
+        return values, present
+
+    def write(self, series: str, start: datetime, values: Iterable) -> int:
+        """
+        Write consecutive quarter-hour values, starting at 'start'.
+        Existing quarters are overwritten, other quarters of the touched days are kept,
+        so this handles appends and partial-day updates alike.
+        :param series: name of the series
+        :param start: timestamp of the first value
+        :param values: values to store; NaN is stored as missing for float series
+        :return: number of days written
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        if values.size == 0:
+            return 0
+        present = np.ones(values.size, dtype=bool)
+        if self.dtype.kind == "f":
+            present = ~np.isnan(values)
+        first_day, quarter = quarter_index(to_utc(start, self.naive_utc))
+        last_day = first_day + (quarter + values.size - 1) // QUARTERS_PER_DAY
+        stored = {day: (np.array(vals), np.array(mask))
+                  for day, vals, mask in self._fetch(series, first_day, last_day)}
+        rows = []
+        offset = 0
+        for day in range(first_day, last_day + 1):
+            day_vals, day_mask = stored.get(day, self._empty_day())
+            count = min(QUARTERS_PER_DAY - quarter, values.size - offset)
+            day_vals[quarter:quarter + count] = values[offset:offset + count]
+            day_mask[quarter:quarter + count] = present[offset:offset + count]
+            rows.append((series, day, day_vals.astype(self.dtype).tobytes(), np.packbits(day_mask).tobytes()))
+            offset += count
+            quarter = 0
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (series, day, vals, mask) VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+        return len(rows)
+
+    def append(self, series: str, values: Iterable, start: Optional[datetime] = None) -> int:
+        """
+        Append values right after the last stored quarter of a series
+        :param series: name of the series
+        :param values: values to append
+        :param start: timestamp to use when the series is still empty
+        :return: number of days written
+        """
+        last = self.last_timestamp(series)
+        if last is None:
+            if start is None:
+                raise ValueError(f"Series {series} is empty, a start timestamp is required")
+            return self.write(series, start, values)
+        return self.write(series, last + timedelta(seconds=SECONDS_PER_QUARTER_HOUR), values)
+
+    def _fetch(self, series: str, first_day: int, last_day: int):
+        cur = self.conn.execute(
+            f"SELECT day, vals, mask FROM {self.table} WHERE series = ? AND day BETWEEN ? AND ? ORDER BY day",
+            (series, first_day, last_day))
+        for day, vals, mask in cur:
+            yield (day,) + self._decode(vals, mask)
+
+    def read(self, series: str, start: datetime, end: datetime) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read the quarters in the half-open range [start, end).
+        :param series: name of the series
+        :param start: first timestamp
+        :param end: timestamp after the last quarter to read
+        :return: (values, present): values of the range and a boolean array telling
+                 which quarters were stored; missing quarters hold 0 (or NaN for floats)
+        """
+        first_day, first_quarter = quarter_index(to_utc(start, self.naive_utc))
+        last_day, end_quarter = quarter_index(to_utc(end, self.naive_utc))
+        size = (last_day - first_day) * QUARTERS_PER_DAY + end_quarter - first_quarter
+        if size <= 0:
+            return np.empty(0, dtype=self.dtype), np.empty(0, dtype=bool)
+        values = np.full(size, np.nan if self.dtype.kind == "f" else 0, dtype=self.dtype)
+        present = np.zeros(size, dtype=bool)
+        for day, day_vals, day_mask in self._fetch(series, first_day, last_day):
+            # position of the first quarter of this day in the result
+            pos = (day - first_day) * QUARTERS_PER_DAY - first_quarter
+            lo, hi = max(0, -pos), min(QUARTERS_PER_DAY, size - pos)
+            if lo >= hi:
+                continue
+            mask = day_mask[lo:hi]
+            values[pos + lo:pos + hi][mask] = day_vals[lo:hi][mask]
+            present[pos + lo:pos + hi] = mask
+        return values, present
+
+    def last_timestamp(self, series: str) -> Optional[datetime]:
+        """
+        Timestamp of the last stored quarter of a series
+        :param series: name of the series
+        :return: timestamp in UTC (timezone-aware) or None if the series is empty
+        """
+        cur = self.conn.execute(
+            f"SELECT day, vals, mask FROM {self.table} WHERE series = ? ORDER BY day DESC", (series,))
+        for day, vals, mask in cur:
+            _, present = self._decode(vals, mask)
+            filled = np.flatnonzero(present)
+            if filled.size:
+                return quarter_timestamp(day, int(filled[-1])).replace(tzinfo=timezone.utc)
+        return None
+
+    def delete(self, series: str) -> None:
+        """
+        Remove all data of a series
+        :param series: name of the series
+        """
+        self.conn.execute(f"DELETE FROM {self.table} WHERE series = ?", (series,))
+        self.conn.commit()
+
+
+if __name__ == "__main__":
+    raise NotImplementedError(f"This module is not meant to be run directly: {__file__}")
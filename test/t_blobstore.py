@@ -0,0 +1,75 @@
+import filecmp
+import os
+import random
+import tempfile
+import unittest
+
+from claar.blobstore import BlobStore
+
+
+class TestCases(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store_dir = os.path.join(self.tmp.name, "store")
+        rng = random.Random(7)
+        shared = rng.randbytes(2 * 2 ** 20)
+        # overlapping contents: b and c share most of their chunks with a
+        self.files = {"a": shared + rng.randbytes(2 ** 20),
+                      "b": shared[:2 ** 20] + b"edited" + shared[2 ** 20:],
+                      "c": rng.randbytes(2 ** 20) + shared}
+        for name, data in self.files.items():
+            with open(self.path(name), "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def pack_bytes(self):
+        pack_dir = os.path.join(self.store_dir, "packs")
+        return sum(os.path.getsize(os.path.join(pack_dir, name)) for name in os.listdir(pack_dir))
+
+    def assertRestores(self, store, name):
+        target = self.path(name + ".restored")
+        self.assertEqual(store.get(name, target), len(self.files[name]))
+        self.assertTrue(filecmp.cmp(self.path(name), target, shallow=False))
+
+    def test_put_deduplicates(self):
+        with BlobStore(self.store_dir) as store:
+            new = [store.put(self.path(name), name)[1] for name in self.files]
+            self.assertEqual(new[0], len(self.files["a"]))
+            self.assertLess(new[1], len(self.files["b"]) // 2)
+            self.assertLess(new[2], len(self.files["c"]) // 2)
+            stats = store.stats()
+            self.assertEqual(stats["logical"], sum(len(data) for data in self.files.values()))
+            self.assertEqual(stats["packed"], self.pack_bytes())
+            for name in self.files:
+                self.assertRestores(store, name)
+
+    def test_delete_and_compact(self):
+        with BlobStore(self.store_dir) as store:
+            for name in self.files:
+                store.put(self.path(name), name)
+            before = self.pack_bytes()
+            store.delete("a")
+            self.assertEqual(self.pack_bytes(), before)  # delete only drops references
+            freed = store.compact()
+            self.assertGreater(freed, 0)
+            self.assertEqual(self.pack_bytes(), before - freed)
+            self.assertEqual(store.stats()["packed"], store.stats()["unique"])
+            self.assertEqual(store.compact(), 0)
+            self.assertRaises(KeyError, store.get, "a", self.path("a.restored"))
+            for name in ("b", "c"):
+                self.assertRestores(store, name)
+        # the compacted index is persistent
+        with BlobStore(self.store_dir) as store:
+            for name in ("b", "c"):
+                self.assertRestores(store, name)
+            store.put(self.path("a"), "a")
+            self.assertRestores(store, "a")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import filecmp
+import os
+import random
+import tempfile
+import unittest
+
+from claar import deltasync
+
+
+class TestCases(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "source")
+        self.target = os.path.join(self.tmp.name, "target")
+        os.makedirs(self.source)
+        os.makedirs(self.target)
+        self.rng = random.Random(42)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, root, name, data):
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(data)
+
+    def test_rebuilt_file_equals_source(self):
+        old = self.rng.randbytes(3 * deltasync.SCAN_WINDOW + 12345)
+        new = old[:1000] + b"inserted" + old[1000:2 * deltasync.SCAN_WINDOW] + self.rng.randbytes(5000) + \
+            old[2 * deltasync.SCAN_WINDOW + 7000:]
+        self.write(self.target, "data.bin", old)
+        self.write(self.source, "data.bin", new)
+        totals = deltasync.sync_directories(self.source, self.target)
+        self.assertEqual(totals["delta"], 1)
+        self.assertGreater(totals["reused"], len(new) // 2)
+        self.assertTrue(filecmp.cmp(os.path.join(self.source, "data.bin"), os.path.join(self.target, "data.bin"),
+                                    shallow=False))
+
+    def test_copy_and_delete(self):
+        self.write(self.source, "new.txt", b"hello")
+        self.write(self.target, "stale.txt", b"bye")
+        totals = deltasync.sync_directories(self.source, self.target, delete=True)
+        self.assertEqual((totals["copy"], totals["delete"]), (1, 1))
+        self.assertEqual(os.listdir(self.target), ["new.txt"])
+
+    def test_weak_checksums_match_block_sums(self):
+        data = self.rng.randbytes(20000)
+        block = deltasync.BLOCK_MIN
+        weak = deltasync.weak_checksums(data, block)
+        self.assertEqual(len(weak), len(data) - block + 1)
+        for k in (0, 1, 777, len(data) - block):
+            window = data[k:k + block]
+            a = sum(window)
+            b = sum((block - i) * byte for i, byte in enumerate(window))
+            self.assertEqual(int(weak[k]), (b & 0xFFFF) << 16 | (a & 0xFFFF))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from claar.scan import FileScanner, TreeWalker
+
+
+class TestCases(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "root")
+        self.db = os.path.join(self.tmp.name, "scan.db")
+        os.makedirs(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data=b"x", mtime=None):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+        return path
+
+    def scan(self, db=None, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return FileScanner(self.root, db or self.db, **options).scan()
+
+    def changes(self, db=None):
+        """
+        Changes of the last generation, relative path -> change type
+        """
+        conn = sqlite3.connect(db or self.db)
+        rows = conn.execute("""SELECT path, change FROM files_changes
+                                WHERE generation = (SELECT MAX(generation) FROM files_generations)""").fetchall()
+        conn.close()
+        return {os.path.relpath(path, self.root): change for path, change in rows}
+
+    def inventory(self, db=None):
+        conn = sqlite3.connect(db or self.db)
+        rows = conn.execute("SELECT path, fsize, mtime_ns, mode FROM files ORDER BY path").fetchall()
+        conn.close()
+        return rows
+
+    def scan_in_slices(self, time_slice, listing_delay):
+        """
+        Scan with a time slice and resume until the scan completes, with a walker slowed down
+        by listing_delay seconds per directory so the pauses fall in the middle of the walk
+        :return: number of pauses
+        """
+        scan_dir = TreeWalker._scan_dir
+
+        def slow_scan_dir(walker, path):
+            time.sleep(listing_delay)
+            scan_dir(walker, path)
+
+        pauses = 0
+        with mock.patch.object(TreeWalker, "_scan_dir", slow_scan_dir):
+            while self.scan(time_slice=time_slice, resume=True, workers=2) is None:
+                pauses += 1
+                self.assertLess(pauses, 1000)
+        return pauses
+
+
+    def test_first_scan_adds_everything(self):
+        self.write("a")
+        self.write("sub/b")
+        self.assertEqual(self.scan(), 0)  # nothing to report on a first scan
+        self.assertEqual(self.changes(), {"a": "A", os.path.join("sub", "b"): "A"})
+        self.assertEqual(len(self.inventory()), 2)
+
+    def test_add_remove_modify(self):
+        removed = self.write("removed")
+        resized = self.write("resized")
+        chmodded = self.write("chmodded")
+        replaced = self.write("replaced")
+        self.write("unchanged")
+        self.scan()
+        os.remove(removed)
+        self.write("resized", b"longer", mtime=os.stat(resized).st_mtime_ns)  # same mtime, other size
+        os.chmod(chmodded, 0o600)
+        os.remove(replaced)
+        self.write("replaced/inner")
+        self.write("added")
+        self.assertEqual(self.scan(), 6)
+        self.assertEqual(self.changes(), {"removed": "R", "resized": "M", "chmodded": "M", "replaced": "R",
+                                          os.path.join("replaced", "inner"): "A", "added": "A"})
+        paths = [os.path.relpath(path, self.root) for path, *_ in self.inventory()]
+        self.assertEqual(paths, ["added", "chmodded", os.path.join("replaced", "inner"), "resized", "unchanged"])
+        self.assertEqual(self.scan(), 0)
+        self.assertEqual(self.changes(), {})
+
+    def test_pruned_subtree(self):
+        self.write("top")
+        touched = self.write("sub/touched")
+        self.write("sub/deep/file")
+        self.scan(prune=True)
+        # a file rewritten in place does not change the mtime of its directory
+        os.utime(touched, ns=(1, 1))
+        self.write("sub/deep/new")  # only the mtime of sub/deep changes
+        self.assertEqual(self.scan(prune=True), 1)
+        self.assertEqual(self.changes(), {os.path.join("sub", "deep", "new"): "A"})
+        self.assertEqual(len(self.inventory()), 4)  # the files of the pruned directories are kept
+        # without pruning the in-place change is found
+        self.assertEqual(self.scan(), 1)
+        self.assertEqual(self.changes(), {os.path.join("sub", "touched"): "M"})
+
+    def test_time_slice_resume_equals_full_scan(self):
+        for i in range(20):
+            for j in range(3):
+                for k in range(10):
+                    self.write(f"d{i}/e{j}/f{k}")
+        full_db = os.path.join(self.tmp.name, "full.db")
+        self.scan(full_db)
+        pauses = self.scan_in_slices(0.02, 0.005)
+        self.assertGreater(pauses, 0)
+        self.assertEqual(self.inventory(), self.inventory(full_db))
+
+
+    def test_pause_keeps_every_directory_once(self):
+        directories = [f"d{i}/e{j}" for i in range(5) for j in range(4)]
+        for directory in directories:
+            for k in range(5):
+                self.write(f"{directory}/f{k}")
+        full_db = os.path.join(self.tmp.name, "full.db")
+        self.scan(full_db)
+        # every directory takes longer to list than a whole slice, yet every slice makes progress
+        pauses = self.scan_in_slices(0.001, 0.01)
+        self.assertGreater(pauses, 0)
+        self.assertLessEqual(pauses, len(directories) + 6)
+        query = "SELECT path, parent, entries, files_digest FROM files_dirs ORDER BY path"
+        conn, full = sqlite3.connect(self.db), sqlite3.connect(full_db)
+        try:
+            self.assertEqual(conn.execute(query).fetchall(), full.execute(query).fetchall())
+            self.assertEqual(conn.execute("SELECT added, removed, modified FROM files_generations").fetchall(),
+                             [(100, 0, 0)])
+            self.assertEqual(conn.execute("SELECT bytes, files FROM files_dirsizes WHERE path = ?",
+                                          (self.root,)).fetchone(), (100, 100))
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM files_frontier").fetchone(), (0,))
+        finally:
+            conn.close()
+            full.close()
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from claar.timeseries import TimeSeriesStore
+
+BRUSSELS = ZoneInfo("Europe/Brussels")
+
+
+class TestCases(unittest.TestCase):
+    def setUp(self):
+        self.store = TimeSeriesStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_dst_fall_back_keeps_both_hours(self):
+        # 2024-10-27: 03:00 CEST becomes 02:00 CET, 02:00-03:00 local occurs twice
+        first = datetime(2024, 10, 27, 2, 0, tzinfo=BRUSSELS, fold=0)
+        second = datetime(2024, 10, 27, 2, 0, tzinfo=BRUSSELS, fold=1)
+        self.store.write("load", first, [1.0, 2.0, 3.0, 4.0])
+        self.store.write("load", second, [5.0, 6.0, 7.0, 8.0])
+        values, present = self.store.read("load", first, second + timedelta(hours=1))
+        np.testing.assert_array_equal(values, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0])
+        self.assertTrue(present.all())
+        self.assertEqual(self.store.last_timestamp("load"), datetime(2024, 10, 27, 1, 45, tzinfo=timezone.utc))
+
+    def test_dst_day_has_100_local_quarters(self):
+        start = datetime(2024, 10, 27, tzinfo=BRUSSELS)
+        end = datetime(2024, 10, 28, tzinfo=BRUSSELS)
+        self.store.write("load", start, np.arange(100.0))
+        values, present = self.store.read("load", start, end)
+        self.assertEqual(len(values), 100)
+        self.assertTrue(present.all())
+        np.testing.assert_array_equal(values, np.arange(100.0))
+
+    def test_naive_timestamps(self):
+        self.assertRaises(ValueError, self.store.write, "load", datetime(2024, 1, 1), [1.0])
+        store = TimeSeriesStore(self.store.conn, naive_utc=True)
+        store.write("load", datetime(2024, 1, 1, 23, 45), [1.0, 2.0])
+        values, _ = self.store.read("load", datetime(2024, 1, 2, tzinfo=timezone.utc),
+                                    datetime(2024, 1, 2, 0, 15, tzinfo=timezone.utc))
+        np.testing.assert_array_equal(values, [2.0])
+
+    def test_append_after_last_quarter(self):
+        start = datetime(2024, 3, 31, 1, 30, tzinfo=BRUSSELS)  # spring forward at 02:00
+        self.store.append("load", [1.0, 2.0], start)
+        self.store.append("load", [3.0, 4.0])
+        values, present = self.store.read("load", start, start + timedelta(hours=1))
+        np.testing.assert_array_equal(values, [1.0, 2.0, 3.0, 4.0])
+        self.assertTrue(present.all())
+
+
+if __name__ == '__main__':
+    unittest.main()